@@ -0,0 +1,5 @@
+"""
+Confluence.md benchmarks, run from repository root:
+
+  $ python -m benchmarks.<name> --help
+"""
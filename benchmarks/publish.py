@@ -0,0 +1,146 @@
+"""
+End-to-end publishing benchmark against a local fake Confluence/Jira instance.
+Every corpus is published twice: first run creates pages, second finds them unchanged
+
+  $ python -m benchmarks.publish --corpus all --latency 0.02
+  $ python -m benchmarks.publish --corpus small --files 1000 --rate_limit 100
+"""
+import os
+import time
+import random
+import tempfile
+import argparse
+from typing import Callable, Dict, List
+
+from src.md2cf.utils.confluencemd import ConfluenceMD
+from src.md2cf.utils.sync import sync_files
+from src.tests.fake_atlassian import FakeAtlassian
+
+
+def large_page(directory: str, fake: FakeAtlassian, args) -> List[str]:
+    """One page of about `--size` megabytes of headings, text, lists, code and tables"""
+    # pylint: disable=unused-argument
+    section = ("## Section {i}\n\n"
+               "Lorem ipsum dolor sit amet, *consectetur* adipiscing elit, sed do **eiusmod** "
+               "tempor incididunt ut labore et dolore magna aliqua.\n\n"
+               "- first item\n- second item with `code`\n\n"
+               "```python\ndef section_{i}():\n    return {i}\n```\n\n"
+               "| Column | Value |\n|--------|-------|\n| row {i} | {i} |\n\n")
+    size = int(args.size * 1024 * 1024)
+    sections = []
+    while sum(len(text) for text in sections) < size:
+        sections.append(section.format(i=len(sections)))
+    return [write(directory, "large.md", "# Large page\n\n" + "".join(sections))]
+
+
+def image_pages(directory: str, fake: FakeAtlassian, args) -> List[str]:
+    """`--files` / 50 pages (at least one) with `--images` images of 64 KB each"""
+    # pylint: disable=unused-argument
+    random.seed(0)
+    files = []
+    for page in range(max(1, args.files // 50)):
+        markdown = f"# Images {page}\n\n"
+        for image in range(args.images):
+            name = f"image{page}_{image}.png"
+            with open(os.path.join(directory, name), "wb") as stream:
+                stream.write(random.randbytes(64 * 1024) if hasattr(random, "randbytes")
+                             else os.urandom(64 * 1024))
+            markdown += f"![image {image}]({name})\n\n"
+        files.append(write(directory, f"images{page}.md", markdown))
+    return files
+
+
+def jira_pages(directory: str, fake: FakeAtlassian, args) -> List[str]:
+    """`--files` / 20 pages (at least one) linking `--issues` issues each, out of a pool
+       shared by all pages"""
+    random.seed(0)
+    keys = [f"AD-{i}" for i in range(1, 5 * args.issues + 1)]
+    for key in keys:
+        fake.add_issue(key, f"Summary of {key}")
+    files = []
+    for page in range(max(1, args.files // 20)):
+        links = " ".join(f"[{key}]" if i % 2 else f"{fake.url}browse/{key}"
+                         for (i, key) in enumerate(random.sample(keys, args.issues)))
+        files.append(write(directory, f"jira{page}.md", f"# Jira {page}\n\n{links}\n"))
+    return files
+
+
+def small_pages(directory: str, fake: FakeAtlassian, args) -> List[str]:
+    """`--files` pages of a few lines each"""
+    # pylint: disable=unused-argument
+    return [write(directory, f"small{page:04}.md",
+                  f"# Small page {page}\n\nA paragraph with a [link](https://example.com).\n")
+            for page in range(args.files)]
+
+
+CORPORA: Dict[str, Callable] = {"large": large_page, "images": image_pages,
+                                "jira": jira_pages, "small": small_pages}
+
+
+def write(directory: str, name: str, markdown: str) -> str:
+    md_file = os.path.join(directory, name)
+    with open(md_file, "w", encoding="utf-8") as stream:
+        stream.write(markdown)
+    return md_file
+
+
+def publish(fake: FakeAtlassian, files: List[str], parent_id: str, args) -> dict:
+    """Publishes files with a new session, returns time, requests and bytes transferred"""
+    fake.reset_stats()
+    confluence = ConfluenceMD(username="user", token="token", url=fake.url,
+                              convert_jira=True)
+    start = time.perf_counter()
+    results = sync_files(confluence, files, parent_id, overwrite=True,
+                         max_workers=args.max_workers,
+                         convert_workers=args.convert_workers)
+    elapsed = time.perf_counter() - start
+    errors = [error for (_file, _page_id, error) in results if error]
+    assert not errors, f"{len(errors)} file(s) failed, first: {errors[0]}"
+    stats = confluence.transport.stats()
+    return {"time": elapsed, "requests": len(fake.requests), "sent": fake.bytes_received,
+            "received": fake.bytes_sent, "throttled": stats["throttled"]}
+
+
+def run(corpus: str, args) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["XDG_CACHE_HOME"] = os.path.join(directory, ".cache")
+        with FakeAtlassian(latency=args.latency, rate_limit=args.rate_limit) as fake:
+            files = CORPORA[corpus](directory, fake, args)
+            size = sum(os.path.getsize(md_file) for md_file in files)
+            parent_id = fake.add_page(f"Benchmark {corpus}")
+            print(f"{corpus}: {len(files)} file(s), {size / 1024:.0f} KB of markdown")
+            for run_name in ["first", "unchanged"]:
+                result = publish(fake, files, parent_id, args)
+                print(f"  {run_name:<10} {result['time']:8.3f} s {result['requests']:6} requests "
+                      f"{result['sent'] / 1024:9.0f} KB sent {result['received'] / 1024:9.0f} KB "
+                      f"received {result['throttled']:4} throttled")
+
+
+def main():
+    """Runs the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--corpus", choices=list(CORPORA) + ["all"], default="all",
+                        help="corpus to publish (default: all)")
+    parser.add_argument("--files", type=int, default=1000,
+                        help="number of small files, other corpora scale from it (default: 1000)")
+    parser.add_argument("--size", type=float, default=0.25,
+                        help="large page size in MB (default: 0.25)")
+    parser.add_argument("--images", type=int, default=10, help="images per page (default: 10)")
+    parser.add_argument("--issues", type=int, default=100, help="issues per page (default: 100)")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="fake server latency per request in seconds (default: 0)")
+    parser.add_argument("--rate_limit", type=int, default=0,
+                        help="requests per second before fake server throttles (default: off)")
+    parser.add_argument("--max_workers", type=int, default=4,
+                        help="parallel publishing threads (default: 4)")
+    parser.add_argument("--convert_workers", type=int, default=0,
+                        help="markdown conversion processes (default: 0)")
+    args = parser.parse_args()
+
+    for corpus in CORPORA if args.corpus == "all" else [args.corpus]:
+        run(corpus, args)
+
+
+if __name__ == "__main__":
+    main()
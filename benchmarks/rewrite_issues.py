@@ -0,0 +1,68 @@
+"""
+Micro-benchmark of Jira link rewriting: single-pass `replace_issue_links`
+against the previous one `re.sub` per issue approach
+
+  $ python -m benchmarks.rewrite_issues --size 5 --links 1000
+"""
+import re
+import time
+import random
+import argparse
+
+from src.md2cf.utils.confluencemd import replace_issue_links
+
+JIRA_URL = "https://dirtyagile.atlassian.net/"
+
+
+def legacy_replace_issue_links(html: str, links: dict) -> str:
+    """Previous implementation, one compiled regex and full html scan per issue"""
+    for (replace, link) in links.items():
+        re_replace = re.compile(r"([^\"])" + re.escape(replace))
+        html = re.sub(re_replace, lambda match, link=link: match.group(1) + link, html)
+    return html
+
+
+def generate_page(size_mb: float, links: int) -> tuple:
+    """Returns html page of about size_mb megabytes with given number of distinct issues"""
+    random.seed(0)
+    filler = "<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>\n"
+    paragraphs = [filler] * int(size_mb * 1024 * 1024 / len(filler))
+    replacements = {}
+    for i in range(links):
+        key = f"AD-{100000 + i}"  # same width, so no key is a prefix of another
+        replace = f"[{key}]" if i % 2 else f"{JIRA_URL}browse/{key}"
+        replacements[replace] = (f"<a href=\"{JIRA_URL}browse/{key}\"><ac:image>"
+                                 f"<ri:url ri:value=\"{JIRA_URL}icon.png\" />"
+                                 f"</ac:image> {key}: Summary of {key} [Open]</a>")
+        paragraphs.insert(random.randrange(len(paragraphs)), f"<p>See {replace}</p>\n")
+    return "".join(paragraphs), replacements
+
+
+def measure(function, *args) -> tuple:
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    """Runs the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--size", type=float, default=5, help="page size in MB (default: 5)")
+    parser.add_argument("--links", type=int, default=1000, help="number of issues (default: 1000)")
+    args = parser.parse_args()
+
+    html, links = generate_page(args.size, args.links)
+    print(f"page: {len(html) / 1024 / 1024:.1f} MB, {len(links)} issue links")
+
+    new_html, new_time = measure(replace_issue_links, html, links)
+    print(f"single pass:   {new_time:8.3f} s")
+    old_html, old_time = measure(legacy_replace_issue_links, html, links)
+    print(f"re.sub/issue:  {old_time:8.3f} s")
+
+    assert new_html == old_html, "single pass output differs from legacy output"
+    print(f"speedup:       {old_time / new_time:8.1f} x, identical output")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,20 +3,24 @@ import pytest
 # pylint: disable=missing-function-docstring
 
 def pytest_addoption(parser):
-    parser.addoption("--user", action="store", required=True,
-            help="Atlassian username/email")
-    parser.addoption("--token", action="store", required=True,
-            help="Atlassian API token (used in cloud instances)")
+    parser.addoption("--user", action="store", required=False,
+            help="Atlassian username/email, live tests need it")
+    parser.addoption("--token", action="store", required=False,
+            help="Atlassian API token (used in cloud instances), live tests need it")
     parser.addoption("--url", action="store", required=False,
             default="https://dirtyagile.atlassian.net/wiki/",
             help="Atlassian instance URL")
 
 @pytest.fixture(scope="class")
 def user(request):
+    if not request.config.getoption("--user"):
+        pytest.skip("live test, needs --user")
     return request.config.getoption("--user")
 
 @pytest.fixture(scope="class")
 def token(request):
+    if not request.config.getoption("--token"):
+        pytest.skip("live test, needs --token")
     return request.config.getoption("--token")
 
 @pytest.fixture(scope="class")
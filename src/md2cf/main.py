@@ -5,11 +5,16 @@ Push markdown files straight to a Confluence page.
 """
 
 import sys
+import json
 import argparse
+import contextlib
 from argparse import RawTextHelpFormatter
 
 from .utils.log import logger, init_logger, headline
-from .utils.confluencemd import ConfluenceMD
+
+# Modules of actions are imported by the actions, so parsing arguments (and `--help`)
+# doesn't load the Atlassian and HTTP stack
+# pylint: disable=import-outside-toplevel
 
 ACTIONS = {}
 
@@ -24,30 +29,176 @@ def register_action(function):
 
 def init_confluence(args):
     """Inits connections to Confluence"""
+    assert args.user, ("No --user parameter is provided, gave up")
+    assert args.token or args.password, ("No --token or --password parameter is provided, gave up")
+    from .utils.confluencemd import ConfluenceMD
+    from .utils.plan import Plan
+    from .utils.transport import RequestScheduler, Transport
     return ConfluenceMD(username=args.user,
                         token=args.token,
                         password=args.password,
-                        md_file=args.file.name,
+                        md_file=args.file.name if args.file else None,
+                        md_text=args.file.read() if args.file is sys.stdin else None,
                         url=args.url,
                         verify_ssl=(not args.no_verify_ssl),
                         add_meta=args.add_meta,
                         add_info_panel=args.add_info,
                         add_label=args.add_label,
-                        convert_jira=args.convert_jira)
+                        convert_jira=args.convert_jira,
+                        force_update=args.force,
+                        max_parallel_uploads=args.max_parallel_uploads,
+                        jira_cache=(not args.no_jira_cache),
+                        refresh_jira_cache=args.refresh_jira_cache,
+                        jira_cache_ttl=args.jira_cache_ttl,
+                        license_cache_ttl=args.license_cache_ttl,
+                        render_cache=(not args.no_render_cache),
+                        manifest_file=args.manifest,
+                        plan=Plan() if args.plan or args.plan_json else None,
+                        transport=Transport(pool_size=args.pool_size,
+                                            keep_alive=(not args.no_keep_alive),
+                                            timeout=args.timeout,
+                                            proxy=args.proxy,
+                                            verify_ssl=(not args.no_verify_ssl),
+                                            scheduler=RequestScheduler(
+                                                max_rps=args.max_rps,
+                                                max_retries=args.max_retries)))
+
+def report_plan(args, plan):
+    """Prints the plan of a dry run, writes it as JSON if requested"""
+    if plan is None:
+        return
+    from .utils.plan import write_plan
+    plan.log()
+    if args.plan_json:
+        write_plan(plan, args.plan_json)
+
+def report_stats(args, confluence):
+    """Logs HTTP stats, prints summary tables and writes JSON report if requested"""
+    confluence.transport.log_stats()
+    if not (args.stats or args.stats_json):
+        return
+    from .utils.stats import Stats
+    report = confluence.stats_report()
+    if args.stats:
+        Stats.log(report)
+    if args.stats_json:
+        Stats.write(report, args.stats_json)
 
 @register_action
 def update(args):
     """Updates page content based on given page_id or metadata in Markdown file"""
+    assert args.file, ("No --file parameter is provided, gave up")
+
     confluence = init_confluence(args)
     confluence.update_existing(args.page_id)
+    report_plan(args, confluence.plan)
+    report_stats(args, confluence)
 
 @register_action
 def create(args):
     """Creates new page under given parent_id"""
     assert args.url, ("No --url parameter is provided, gave up")
+    assert args.file, ("No --file parameter is provided, gave up")
 
     confluence = init_confluence(args)
     confluence.create_new(args.parent_id, args.title, args.overwrite)
+    report_plan(args, confluence.plan)
+    report_stats(args, confluence)
+
+@register_action
+def sync(args):
+    """Updates (or creates under parent_id) pages for all files in --dir"""
+    assert args.dir, ("No --dir parameter is provided, gave up")
+    from .utils.sync import find_markdown_files, sync_files, log_summary
+    from .utils.plan import plan_files
+
+    files = find_markdown_files(args.dir)
+    confluence = init_confluence(args)
+    if confluence.plan is not None:
+        report_plan(args, plan_files(confluence, files, args.parent_id, args.overwrite,
+                                     args.max_workers))
+        report_stats(args, confluence)
+        return
+    if args.use_async:
+        assert not args.manifest, ("Can't use --manifest with --use_async, gave up")
+        from .utils.aio import publish_files
+        results = publish_files(confluence, files, args.parent_id, args.overwrite,
+                                args.max_in_flight)
+    else:
+        results = sync_files(confluence, files, args.parent_id, args.overwrite,
+                             args.max_workers, args.convert_workers)
+    failed = log_summary(results)
+    report_stats(args, confluence)
+    if failed:
+        raise RuntimeError(f"Failed to publish {failed} of {len(results)} file(s)")
+
+@register_action
+def tree(args):
+    """Publishes --dir as a tree of pages under parent_id, directories become parent pages"""
+    assert args.dir, ("No --dir parameter is provided, gave up")
+    assert args.parent_id, ("No --parent_id parameter is provided, gave up")
+    from .utils.sync import log_summary
+    from .utils.tree import publish_tree
+
+    confluence = init_confluence(args)
+    results = publish_tree(confluence, args.dir, args.parent_id, args.overwrite,
+                           args.max_workers)
+    report_plan(args, confluence.plan)
+    failed = log_summary(results) if confluence.plan is None else 0
+    report_stats(args, confluence)
+    if failed:
+        raise RuntimeError(f"Failed to publish {failed} of {len(results)} page(s)")
+
+@register_action
+def watch(args):
+    """Republishes --file or files in --dir whenever they or their images change"""
+    assert args.file or args.dir, ("No --file or --dir parameter is provided, gave up")
+    assert args.file is not sys.stdin, ("Can't watch stdin, gave up")
+    assert not (args.plan or args.plan_json), ("Can't plan in watch mode, gave up")
+    from .utils.watch import Watcher
+
+    confluence = init_confluence(args)
+    watcher = Watcher(confluence, args.file.name if args.file else args.dir,
+                      args.parent_id, args.overwrite, args.interval, args.debounce)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        logger.info("Stopped watching, %i update(s) published", watcher.published)
+    report_stats(args, confluence)
+
+@register_action
+def export(args):
+    """Converts --file or files in --dir to Confluence storage format, no network access"""
+    assert args.file or args.dir, ("No --file or --dir parameter is provided, gave up")
+    from .utils.export import export_files
+    from .utils.md2html import md_to_document
+    from .utils.sync import find_markdown_files
+
+    if args.file is sys.stdin:
+        assert not args.out, ("Can't export stdin to --out, gave up")
+        print(md_to_document("<stdin>", args.add_info, text=args.file.read()).html)
+        return
+
+    files = [args.file.name] if args.file else find_markdown_files(args.dir)
+    entries = export_files(files, args.out, args.add_info, not args.no_render_cache,
+                           args.convert_workers)
+    failed = 0
+    for entry in entries:
+        if entry["error"]:
+            failed += 1
+            logger.error("  FAILED  %s: %s", entry["file"], entry["error"])
+            continue
+        logger.info("  OK      %s -> %s, %i image(s)", entry["file"], entry["output"] or "stdout",
+                    len(entry["images"]))
+        for image in entry["images"]:
+            logger.info("            %s (%i bytes)", image["file"], image["size"])
+        if not args.out and args.file:
+            print(entry["html"])
+        elif not args.out:
+            print(json.dumps({"file": entry["file"], "html": entry["html"]}))
+    logger.info("%i file(s) exported, %i failed", len(entries) - failed, failed)
+    if failed:
+        raise RuntimeError(f"Failed to export {failed} of {len(entries)} file(s)")
 
 def main():
     """Markdown to Confluence
@@ -75,6 +226,27 @@ Example workflow:
 
   Consider adding useful --add_info option.
 
+4/ Publish a whole directory (or glob) at once, files without metadata are created
+  under --parent_id and titled after the file name:
+
+  $ confluence.md --user user@name.net --token 9a8dsadsh --url https://your-domain.atlassian.net \\
+        sync --dir docs/ --parent_id 182371 --add_meta
+
+5/ Mirror a directory tree as a page tree, `index.md` or `README.md` of every directory
+  becomes its parent page:
+
+  $ confluence.md --user user@name.net --token 9a8dsadsh --url https://your-domain.atlassian.net \\
+        tree --dir docs/ --parent_id 182371
+
+6/ Keep pages in sync while editing, changed files are republished on save:
+
+  $ confluence.md --user user@name.net --token 9a8dsadsh watch --dir docs/
+
+7/ Convert to Confluence storage format without connecting to Confluence, e.g. to
+  validate docs before merging or to upload them from another machine:
+
+  $ confluence.md export --dir docs/ --out build/
+
 To create Atlassian API Token go to:
   https://id.atlassian.com/manage-profile/security/api-tokens
 
@@ -99,8 +271,7 @@ Actions:
     auth_args = parser.add_argument_group('required auth parameters')
     auth_args.add_argument("-u", "--user",
                            action="store",
-                           required=True,
-                           help="Atlassian username/email")
+                           help="Atlassian username/email (not needed by export)")
     auth_args.add_argument("-l", "--url",
                            action="store",
                            required=False,
@@ -111,7 +282,36 @@ Actions:
                            default=False,
                            help="Don't verify SSL cert in on-prem instances")
 
-    secret_args = auth_args.add_mutually_exclusive_group(required=True)
+    http_args = parser.add_argument_group('http connection parameters')
+    http_args.add_argument("--pool_size",
+                           action="store",
+                           type=int,
+                           default=20,
+                           help="max number of kept-alive connections per host (default: 20)")
+    http_args.add_argument("--timeout",
+                           action="store",
+                           type=int,
+                           default=75,
+                           help="HTTP request timeout in seconds (default: 75)")
+    http_args.add_argument("--proxy",
+                           action="store",
+                           help="HTTP(S) proxy URL")
+    http_args.add_argument("--no_keep_alive",
+                           action="store_true",
+                           default=False,
+                           help="close connection after every request")
+    http_args.add_argument("--max_rps",
+                           action="store",
+                           type=float,
+                           default=0,
+                           help="max number of requests per second (default: unlimited)")
+    http_args.add_argument("--max_retries",
+                           action="store",
+                           type=int,
+                           default=5,
+                           help="max retries of a throttled (429/503) request (default: 5)")
+
+    secret_args = auth_args.add_mutually_exclusive_group()
     secret_args.add_argument("-t", "--token",
                              action="store",
                              required=False,
@@ -141,8 +341,56 @@ Actions:
     parser.add_argument("--file",
                         action="store",
                         type=argparse.FileType('r'),
-                        required=True,
-                        help="input markdown file to process")
+                        required=False,
+                        help="input markdown file to process (`-` reads from stdin)")
+
+    sync_args = parser.add_argument_group('sync arguments')
+    sync_args.add_argument("--dir",
+                           action="store",
+                           help="directory or glob pattern of markdown files to process")
+    sync_args.add_argument("--max_workers",
+                           action="store",
+                           type=int,
+                           default=4,
+                           help="number of files published in parallel (default: 4)")
+    sync_args.add_argument("--convert_workers",
+                           action="store",
+                           type=int,
+                           default=0,
+                           help="number of processes converting markdown, 1 converts in "
+                               "publishing threads (default: 0, a process per CPU for more "
+                               "than 50 files)")
+    sync_args.add_argument("--use_async",
+                           action="store_true",
+                           help="publish all files concurrently on one event loop "
+                               "(requires `confluence.md[async]`, not with --manifest)")
+    sync_args.add_argument("--max_in_flight",
+                           action="store",
+                           type=int,
+                           default=100,
+                           help="max number of concurrent HTTP requests with --use_async "
+                               "(default: 100)")
+
+    export_args = parser.add_argument_group('export arguments')
+    export_args.add_argument("--out",
+                             action="store",
+                             help="directory to write storage format files and export.json "
+                                 "listing images to (default: stdout, one JSON line per file "
+                                 "with --dir)")
+
+    watch_args = parser.add_argument_group('watch arguments')
+    watch_args.add_argument("--interval",
+                            action="store",
+                            type=float,
+                            default=1.0,
+                            help="seconds between checks for changes when watchdog "
+                                "isn't installed (default: 1)")
+    watch_args.add_argument("--debounce",
+                            action="store",
+                            type=float,
+                            default=0.5,
+                            help="seconds files must stay unchanged before "
+                                "republishing (default: 0.5)")
 
     parser.add_argument("--add_meta", action="store_true",
                         help="adds metadata to .md file for easy editing")
@@ -156,6 +404,69 @@ Actions:
                         default=False,
                         help="convert all Jira links to issue snippets "
                             "(either short [KEY-ID] format or full URL)")
+    parser.add_argument("--no_jira_cache",
+                        action="store_true",
+                        default=False,
+                        help="don't use local cache of Jira issues")
+    parser.add_argument("--refresh_jira_cache",
+                        action="store_true",
+                        default=False,
+                        help="get all Jira issues from Jira and refresh the local cache")
+    parser.add_argument("--jira_cache_ttl",
+                        action="store",
+                        type=int,
+                        default=24 * 3600,
+                        help="seconds after which cached Jira issues expire (default: 86400)")
+    parser.add_argument("--license_cache_ttl",
+                        action="store",
+                        type=int,
+                        default=24 * 3600,
+                        help="seconds after which cached Secure Markdown license state "
+                            "expires (default: 86400)")
+
+    parser.add_argument("--no_render_cache",
+                        action="store_true",
+                        default=False,
+                        help="always convert markdown, don't use cached HTML")
+    parser.add_argument("--manifest",
+                        action="store",
+                        help="JSON file recording page id, title, version and digests of "
+                            "published files, saves lookups on later runs")
+    parser.add_argument("--plan",
+                        action="store_true",
+                        help="dry run: report pages to create, update or skip and attachments "
+                            "to upload without writing anything")
+    parser.add_argument("--plan_json",
+                        action="store",
+                        help="dry run writing the plan as JSON to given file (`-` for stdout)")
+    parser.add_argument("--stats",
+                        action="store_true",
+                        help="print time spent per stage, requests per endpoint and cache "
+                            "hits at the end")
+    parser.add_argument("--stats_json",
+                        action="store",
+                        help="write time spent per stage, requests per endpoint, bytes, "
+                            "cache hits and retries as JSON to given file (`-` for stdout)")
+    parser.add_argument("--profile",
+                        action="store_true",
+                        help="profile the action with cProfile, markdown is converted in "
+                            "the profiled process")
+    parser.add_argument("--profile_out",
+                        action="store",
+                        default="confluence.md.prof",
+                        help="file the profile is written to, stage and request timeline goes "
+                            "to PROFILE_OUT.trace.json (default: confluence.md.prof)")
+    parser.add_argument("--force",
+                        action="store_true",
+                        default=False,
+                        help="update the page even if its content hasn't changed since "
+                            "the last push")
+
+    parser.add_argument("--max_parallel_uploads",
+                        action="store",
+                        type=int,
+                        default=4,
+                        help="number of images uploaded in parallel (default: 4)")
 
     parser.add_argument("-v", "--verbose",
                         action="store_true",
@@ -174,8 +485,13 @@ Actions:
     args = parser.parse_args()
     init_logger(args)
 
+    if args.profile:
+        args.convert_workers = 1
     try:
-        globals()[args.action](args)
+        if args.profile:
+            from .utils.profiling import profile
+        with profile(args.profile_out) if args.profile else contextlib.nullcontext():
+            globals()[args.action](args)
     # pylint: disable=broad-exception-caught
     except (RuntimeError, AssertionError, Exception) as error:
         logger.error(error)
@@ -0,0 +1,326 @@
+"""
+Asynchronous publishing engine, keeps many page updates and uploads in flight
+on a single event loop. Requires the optional `aiohttp` dependency
+"""
+import os
+import json
+import time
+import base64
+import asyncio
+from typing import Any, Callable, List, Optional, Tuple
+
+from .log import logger
+from .md2html import MarkdownDocument
+from .confluencemd import ATTACHMENTS_PAGE_SIZE, collect_attachments
+from .sync import index_children, page_title, seed_links
+
+
+class RequestError(RuntimeError):
+    """Error response to a request, with its HTTP status"""
+
+    def __init__(self, message: str, status: int) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class AsyncConfluenceMD:
+    """Async counterpart of ConfluenceMD `update_existing` and `create_new`.
+       Uses settings, caches and request scheduler of given ConfluenceMD instance,
+       at most `max_in_flight` HTTP requests are sent at once.
+       Markdown conversion and Jira links resolution run in the default executor"""
+
+    def __init__(self, confluence, max_in_flight: int = 100) -> None:
+        try:
+            # pylint: disable=import-outside-toplevel
+            import aiohttp
+        except ImportError as error:
+            raise ImportError("Async publishing requires aiohttp, "
+                              "install it with `pip install confluence.md[async]`") from error
+        self.aiohttp = aiohttp
+        self.confluence = confluence
+        self.max_in_flight = max(1, max_in_flight)
+        self.semaphore = None
+        self.session = None
+
+    async def __aenter__(self) -> "AsyncConfluenceMD":
+        transport = self.confluence.transport
+        connector = self.aiohttp.TCPConnector(
+            limit=self.max_in_flight,
+            ssl=None if transport.session.verify else False,
+            force_close=transport.session.headers.get("Connection") == "close")
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        self.session = self.aiohttp.ClientSession(
+            connector=connector,
+            timeout=self.aiohttp.ClientTimeout(total=transport.timeout),
+            headers={"Accept": "application/json",
+                     "Authorization": AsyncConfluenceMD.__basic_auth(*self.confluence.auth)})
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.session.close()
+
+    @staticmethod
+    def __basic_auth(username: str, password: str) -> str:
+        credentials = base64.b64encode(f"{username}:{password}".encode("utf-8"))
+        return "Basic " + credentials.decode("ascii")
+
+    async def update_existing(self, md_file: str, page_id: str = None,
+                              document: Optional[MarkdownDocument] = None) -> str:
+        """Updates an existing page by given page_id or the one from file metadata"""
+        conf_md = self.confluence.for_file(md_file)
+        document = document or await self.__run(conf_md.convert)
+        conf_md.use_document_url(document)
+        html = await self.__run(
+            lambda: conf_md.rewrite_links(conf_md.rewrite_issues(document.html)))
+        page_id = page_id or document.page_id
+        assert page_id, (
+            f"Can't update page without page_id given either by "
+            f"`--page_id` parameter or via `confluence-url` tag in `{md_file}` file"
+        )
+
+        page = await self.__request(conf_md, "GET", f"rest/api/content/{page_id}",
+                                    params={"expand": "version"})
+        title = page["title"]
+        digest = await self.__run(conf_md.page_digest, title, html, document.images)
+        if conf_md.is_up_to_date(page_id, digest):
+            logger.info("Page `%s` is up to date with `%s`, skipping", title, md_file)
+            conf_md.stats.count("pages_skipped")
+            conf_md.link_index.add(md_file, page_id)
+            return page_id
+
+        await self.__attach_images(conf_md, page_id, document.images)
+        response = await self.__update_page(conf_md, page_id, title, html,
+                                            page["version"]["number"])
+        await self.__finish(conf_md, document, response, digest)
+        conf_md.stats.count("pages_updated")
+        return page_id
+
+    async def create_new(self, md_file: str, parent_id: str, title: str, overwrite: bool,
+                         document: Optional[MarkdownDocument] = None) -> str:
+        """Creates a new page under given parent_id, or overwrites existing one"""
+        assert title, "Provide a title for a newly created page"
+        assert parent_id, "Provide parent_id for a newly created page"
+        conf_md = self.confluence.for_file(md_file)
+        (space, page) = await self.__run(conf_md.lookup_page, parent_id, title)
+        assert not page or overwrite, (
+            f"Page titled `{title}` already exists in "
+            f"the `{space}` space. Use `--overwrite` to force it."
+        )
+
+        document = document or await self.__run(conf_md.convert)
+        html = await self.__run(
+            lambda: conf_md.rewrite_links(conf_md.rewrite_issues(document.html)))
+        assert not document.page_id or overwrite, (
+            f"Metadata pointing to an existing page "
+            f"id `{document.page_id}` present in the given markdown file. "
+            f"Use `--overwrite` to force it."
+        )
+
+        overwrite_id = page["id"] if page else document.page_id
+        digest = await self.__run(conf_md.page_digest, title, html, document.images)
+        if overwrite_id and conf_md.is_up_to_date(overwrite_id, digest):
+            logger.info("Page `%s` is up to date with `%s`, skipping", title, md_file)
+            conf_md.stats.count("pages_skipped")
+            conf_md.link_index.add(md_file, overwrite_id)
+            return overwrite_id
+
+        if overwrite_id:
+            logger.debug("Overwriting existing page `%s` based on `%s` file", title, md_file)
+            version = page["version"]["number"] if page else None
+            await self.__attach_images(conf_md, overwrite_id, document.images)
+            response = await self.__update_page(conf_md, overwrite_id, title, html, version)
+        else:
+            logger.debug("Creating new page `%s` based on `%s` file", title, md_file)
+            with conf_md.stats.stage("create_page"):
+                response = await self.__request(conf_md, "POST", "rest/api/content", json={
+                    "type": "page", "title": title, "space": {"key": space},
+                    "ancestors": [{"type": "page", "id": parent_id}],
+                    "body": {"storage": {"value": html, "representation": "storage"}},
+                    "metadata": {"properties": {"editor": {"value": "v2"}}}})
+            conf_md.index_new_page(parent_id, space, title, response)
+            await self.__attach_images(conf_md, response["id"], document.images, new_page=True)
+
+        await self.__finish(conf_md, document, response, digest)
+        conf_md.stats.count("pages_updated" if overwrite_id else "pages_created")
+        return response["id"]
+
+    async def publish_many(self, files: List[str], parent_id: Optional[str] = None,
+                           overwrite: bool = False
+                           ) -> List[Tuple[str, Optional[str], Optional[Exception]]]:
+        """Publishes all files concurrently, same as `sync_files`.
+           Returns (md_file, page_id, error) per file"""
+        if parent_id:
+            await self.__run(index_children, self.confluence, parent_id, files)
+
+        async def publish(md_file: str) -> Tuple[str, Optional[str], Optional[Exception]]:
+            try:
+                document = await self.__run(self.confluence.for_file(md_file).convert)
+                if document.page_id or not parent_id:
+                    page_id = await self.update_existing(md_file, document=document)
+                else:
+                    title = page_title(md_file)
+                    page_id = await self.create_new(md_file, parent_id, title, overwrite,
+                                                    document=document)
+                return (md_file, page_id, None)
+            # pylint: disable=broad-exception-caught
+            except (RuntimeError, AssertionError, Exception) as error:
+                logger.debug("Publishing `%s` failed: %s", md_file, error)
+                return (md_file, None, error)
+
+        seed_links(self.confluence, files, parent_id)
+        results = await asyncio.gather(*(publish(md_file) for md_file in files))
+
+        paths = {os.path.abspath(md_file): md_file for md_file in files}
+        pending = [paths[path] for path in self.confluence.link_index.pending() if path in paths]
+        if pending:
+            logger.info("Updating links in %i page(s)", len(pending))
+        updates = await asyncio.gather(
+            *(self.update_existing(md_file, self.confluence.link_index.get(md_file))
+              for md_file in pending), return_exceptions=True)
+        errors = {md_file: error for (md_file, error) in zip(pending, updates)
+                  if isinstance(error, Exception)}
+        return [(md_file, None, errors[md_file]) if md_file in errors else result
+                for (md_file, result) in zip(files, results)]
+
+    async def __update_page(self, conf_md, page_id: str, title: str, html: str,
+                            version: Optional[int]) -> dict:
+        """Puts next page version, refetches the version once on conflict"""
+        async def put(version: int) -> dict:
+            logger.debug("Updating page_id `%s` titled `%s`", page_id, title)
+            return await self.__request(conf_md, "PUT", f"rest/api/content/{page_id}", json={
+                "id": page_id, "type": "page", "title": title,
+                "body": {"storage": {"value": html, "representation": "storage"}},
+                "version": {"number": version + 1, "minorEdit": True}})
+
+        async def get_version() -> int:
+            page = await self.__request(conf_md, "GET", f"rest/api/content/{page_id}",
+                                        params={"expand": "version"})
+            return page["version"]["number"]
+
+        with conf_md.stats.stage("update_page"):
+            try:
+                return await put(version if version is not None else await get_version())
+            except RequestError as error:
+                if error.status != 409:
+                    raise
+                logger.debug("Page `%s` changed meanwhile, retrying with new version", page_id)
+                return await put(await get_version())
+
+    async def __finish(self, conf_md, document: MarkdownDocument, response: dict,
+                       digest: str) -> None:
+        """Adds metadata and label, stores digest of the published page"""
+        page_id = response["id"]
+        if conf_md.add_meta:
+            confluence_url = response["_links"]["base"] + response["_links"]["webui"]
+            await self.__run(conf_md.add_meta_to_file, document, confluence_url)
+        if conf_md.add_label:
+            with conf_md.stats.stage("label"):
+                await self.__request(conf_md, "POST", f"rest/api/content/{page_id}/label",
+                                     json={"prefix": "global", "name": conf_md.add_label})
+        await self.__run(conf_md.store_digest, page_id, digest)
+        conf_md.link_index.add(conf_md.md_file, page_id)
+
+    async def __attach_images(self, conf_md, page_id: str, images: List[Tuple[str, str]],
+                              new_page: bool = False) -> None:
+        """Uploads changed images concurrently, failures are reported per file"""
+        if not images:
+            return
+        with conf_md.stats.stage("attachments"):
+            existing = {} if new_page else await self.__get_attachments(conf_md, page_id)
+            uploads = await self.__run(conf_md.get_uploads, page_id, images, existing)
+            results = await asyncio.gather(*(self.__upload_attachment(conf_md, *upload)
+                                             for upload in uploads), return_exceptions=True)
+        errors = []
+        for (upload, result) in zip(uploads, results):
+            if isinstance(result, Exception):
+                logger.error("Unable to upload image file `%s`: %s", upload[1], result)
+                errors.append(upload[1])
+        conf_md.stats.count("images_uploaded", len(uploads) - len(errors))
+        conf_md.stats.count("images_unchanged", len(images) - len(uploads))
+        if errors:
+            raise RuntimeError(f"Failed to upload {len(errors)} of {len(uploads)} image(s): "
+                               f"{', '.join(errors)}")
+
+    async def __get_attachments(self, conf_md, page_id: str) -> dict:
+        """Returns all page attachments by file name"""
+        attachments = {}
+        start = 0
+        while start is not None:
+            start = collect_attachments(attachments, await self.__request(
+                conf_md, "GET", f"rest/api/content/{page_id}/child/attachment",
+                params={"start": start, "limit": ATTACHMENTS_PAGE_SIZE}), start)
+        return attachments
+
+    async def __upload_attachment(self, conf_md, page_id: str, path: str, name: str,
+                                  comment: str, attachment_id: Optional[str]) -> None:
+        content_type = conf_md.content_types.get(os.path.splitext(path)[-1], "application/binary")
+        url = f"rest/api/content/{page_id}/child/attachment"
+        if attachment_id:
+            url += f"/{attachment_id}/data"
+        content = await self.__run(AsyncConfluenceMD.__read_file, path)
+
+        def form():
+            data = self.aiohttp.FormData()
+            data.add_field("file", content, filename=name, content_type=content_type)
+            data.add_field("comment", comment)
+            data.add_field("minorEdit", "true")
+            return data
+
+        await self.__request(conf_md, "POST", url, data=form,
+                             headers={"X-Atlassian-Token": "no-check"})
+
+    @staticmethod
+    def __read_file(path: str) -> bytes:
+        with open(path, "rb") as stream:
+            return stream.read()
+
+    async def __request(self, conf_md, method: str, path: str,
+                        data: Optional[Callable[[], Any]] = None, **kwargs) -> dict:
+        """Sends request through shared scheduler (rate limit and retries of throttled
+           requests), raises RequestError on error response. Form `data` is given as a
+           factory, so it can be sent again on retry"""
+        scheduler = conf_md.transport.scheduler
+        url = conf_md.conf_url + path
+        proxy = conf_md.transport.session.proxies.get(url.split(":")[0])
+        attempt = 0
+        while True:
+            async with self.semaphore:
+                delay = scheduler.reserve_slot()
+                if delay:
+                    await asyncio.sleep(delay)
+                start = time.perf_counter()
+                async with self.session.request(method, url, proxy=proxy,
+                                                data=data() if data else None,
+                                                **kwargs) as response:
+                    status, headers = response.status, response.headers
+                    text = await response.text()
+                    conf_md.stats.add_request(
+                        method, url, status,
+                        int(response.request_info.headers.get("Content-Length") or 0),
+                        len(text.encode("utf-8")), start)
+            delay = scheduler.get_retry_delay(method, status, headers, attempt)
+            if delay is None:
+                break
+            logger.debug("HTTP: %s throttled with %i, retrying in %.1fs", url, status, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        if status >= 400:
+            raise RequestError(f"{method} {path} failed with {status}: {text[:200]}", status)
+        return json.loads(text) if text else {}
+
+    @staticmethod
+    async def __run(function: Callable, *args) -> Any:
+        """Runs blocking function in the default executor"""
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+def publish_files(confluence, files: List[str], parent_id: Optional[str] = None,
+                  overwrite: bool = False, max_in_flight: int = 100
+                  ) -> List[Tuple[str, Optional[str], Optional[Exception]]]:
+    """Synchronous wrapper running `AsyncConfluenceMD.publish_many` in a new event loop"""
+    async def publish() -> List[Tuple[str, Optional[str], Optional[Exception]]]:
+        async with AsyncConfluenceMD(confluence, max_in_flight) as engine:
+            return await engine.publish_many(files, parent_id, overwrite)
+
+    return asyncio.run(publish())
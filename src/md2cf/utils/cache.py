@@ -0,0 +1,322 @@
+"""
+confluence.md local state and digests
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+def tool_version() -> str:
+    """Returns installed confluence.md version"""
+    try:
+        # pylint: disable=import-outside-toplevel
+        from importlib.metadata import version, PackageNotFoundError
+        try:
+            return version("confluence.md")
+        except PackageNotFoundError:
+            return "dev"
+    except ImportError:
+        return "unknown"
+
+
+def cache_dir() -> str:
+    """Returns (and creates) per-user cache directory"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, "confluence.md")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def file_digest(path: str) -> str:
+    """Returns sha256 hex digest of given file contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for chunk in iter(lambda: stream.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_digest(*parts: Optional[str]) -> str:
+    """Returns sha256 hex digest of given strings"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update((part or "").encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class JsonStore:
+    """Small key-value store persisted as JSON file, safe to share between threads"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = self.__load()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Returns value stored under given key"""
+        with self.lock:
+            return self.data.get(key, default)
+
+    def set(self, key: str, value: Any) -> None:
+        """Stores value under given key and saves the file"""
+        self.update({key: value})
+
+    def update(self, values: Dict[str, Any]) -> None:
+        """Stores all given values and saves the file once"""
+        with self.lock:
+            self.data = self.__load()
+            self.data.update(values)
+            self.__save()
+
+    def __load(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as stream:
+                return json.load(stream)
+        except (OSError, ValueError):
+            return {}
+
+    def __save(self) -> None:
+        """Writes to a temporary file first, so concurrent readers never see partial file"""
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        descriptor, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(descriptor, "w", encoding="utf-8") as stream:
+            json.dump(self.data, stream, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+class Manifest:
+    """Sync state of published markdown files: page id, title, space, last pushed version,
+       content digest and attachment digests. Files are keyed by their path relative to the
+       manifest, so it can be kept (and committed) together with the docs. Entries are kept
+       in memory and the file is written after every change, or once at the end of `batch`"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = JsonStore(path).data
+        self.changed: Dict[str, dict] = {}
+        self.batches = 0
+
+    def get(self, md_file: str) -> Optional[dict]:
+        """Returns state recorded for given markdown file"""
+        with self.lock:
+            return self.data.get(self.__key(md_file))
+
+    def set(self, md_file: str, entry: dict) -> None:
+        """Records state of given markdown file"""
+        with self.lock:
+            self.data[self.__key(md_file)] = entry
+            self.changed[self.__key(md_file)] = entry
+            batched = self.batches > 0
+        if not batched:
+            self.save()
+
+    def entries(self) -> Dict[str, dict]:
+        """Returns all recorded entries by key"""
+        with self.lock:
+            return dict(self.data)
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Writes changes made in the block once, when the outermost batch ends"""
+        with self.lock:
+            self.batches += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.batches -= 1
+                batched = self.batches > 0
+            if not batched:
+                self.save()
+
+    def save(self) -> None:
+        """Writes changed entries over the current file, keeping entries written by others"""
+        with self.lock:
+            if not self.changed:
+                return
+            store = JsonStore(self.path)
+            store.update(self.changed)
+            self.data = store.data
+            self.changed = {}
+
+    def __key(self, md_file: str) -> str:
+        base = os.path.dirname(os.path.abspath(self.path))
+        return os.path.relpath(os.path.abspath(md_file), base).replace(os.sep, "/")
+
+
+class JiraIssueCache:
+    """SQLite backed cache of resolved Jira issues keyed by Jira URL and issue key.
+       Entries expire after `ttl` seconds, least recently used ones are evicted
+       above `max_entries`"""
+
+    def __init__(self, path: Optional[str] = None, ttl: int = 24 * 3600,
+                 max_entries: int = 10000) -> None:
+        self.path = path or os.path.join(cache_dir(), "jira.sqlite")
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        with self.__connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS issues ("
+                               "url TEXT, key TEXT, summary TEXT, status TEXT, icon TEXT, "
+                               "fetched REAL, used REAL, PRIMARY KEY (url, key))")
+
+    def get_many(self, url: str, keys: List[str]) -> Dict[str, Tuple[str, str, str]]:
+        """Returns (summary, status, issue type icon url) of not expired cached issues"""
+        now = time.time()
+        found = {}
+        with self.__connect() as connection:
+            for key in keys:
+                row = connection.execute(
+                    "SELECT summary, status, icon FROM issues WHERE url = ? AND key = ? "
+                    "AND fetched > ?", (url, key, now - self.ttl)).fetchone()
+                if row:
+                    found[key] = tuple(row)
+            connection.executemany("UPDATE issues SET used = ? WHERE url = ? AND key = ?",
+                                   [(now, url, key) for key in found])
+        with self.lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, url: str, issues: Dict[str, Tuple[str, str, str]]) -> None:
+        """Stores resolved issues and evicts least recently used entries"""
+        now = time.time()
+        with self.__connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO issues VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(url, key, summary, status, icon, now, now)
+                 for (key, (summary, status, icon)) in issues.items() if summary])
+            connection.execute(
+                "DELETE FROM issues WHERE rowid IN (SELECT rowid FROM issues "
+                "ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    @contextmanager
+    def __connect(self) -> Iterator[sqlite3.Connection]:
+        """New connection per call, so the cache can be used from many threads and processes"""
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
+class DigestStore:
+    """SQLite backed digests of content last pushed to each page, keyed by page URL.
+       Storing a digest writes one row, least recently pushed pages above `max_entries`
+       are evicted when the store is opened"""
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = 100000) -> None:
+        self.path = path or os.path.join(cache_dir(), "digests.sqlite")
+        with self.__connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS digests ("
+                               "key TEXT PRIMARY KEY, digest TEXT, pushed REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS digests_pushed ON digests (pushed)")
+            connection.execute(
+                "DELETE FROM digests WHERE rowid IN (SELECT rowid FROM digests "
+                "ORDER BY pushed DESC LIMIT -1 OFFSET ?)", (max_entries,))
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns digest stored under given key"""
+        with self.__connect() as connection:
+            row = connection.execute("SELECT digest FROM digests WHERE key = ?",
+                                     (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, digest: str) -> None:
+        """Stores digest under given key"""
+        with self.__connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?)",
+                               (key, digest, time.time()))
+
+    @contextmanager
+    def __connect(self) -> Iterator[sqlite3.Connection]:
+        """New connection per call, so the store can be used from many threads and processes"""
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
+class RenderCache:
+    """Content-addressed cache of rendered markdown. Every entry is a separate JSON file
+       written atomically, so parallel workers and processes can share the cache.
+       Least recently used entries are removed when the cache grows above `max_bytes`"""
+
+    def __init__(self, path: Optional[str] = None, max_bytes: int = 256 * 1024 * 1024) -> None:
+        self.path = path or os.path.join(cache_dir(), "render")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self.size = sum(size for (_path, size, _used) in self.__entries())
+
+    def get(self, key: str) -> Optional[dict]:
+        """Returns cached entry and marks it as recently used"""
+        entry_path = os.path.join(self.path, key + ".json")
+        try:
+            with open(entry_path, "r", encoding="utf-8") as stream:
+                entry = json.load(stream)
+            os.utime(entry_path)
+        except (OSError, ValueError):
+            entry = None
+        self.count(entry is not None)
+        return entry
+
+    def count(self, hit: bool) -> None:
+        """Counts a cache hit or miss, also of lookups done by worker processes"""
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, key: str, entry: dict) -> None:
+        """Stores entry under given key"""
+        descriptor, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(descriptor, "w", encoding="utf-8") as stream:
+            json.dump(entry, stream)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, os.path.join(self.path, key + ".json"))
+        with self.lock:
+            self.size += size
+            if self.size > self.max_bytes:
+                self.__evict()
+
+    def __evict(self) -> None:
+        """Removes least recently used entries until the cache shrinks to 80% of max_bytes"""
+        entries = sorted(self.__entries(), key=lambda entry: entry[2])
+        self.size = sum(size for (_path, size, _used) in entries)
+        for (entry_path, size, _used) in entries:
+            if self.size <= self.max_bytes * 0.8:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            self.size -= size
+
+    def __entries(self) -> List[Tuple[str, int, float]]:
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".json"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
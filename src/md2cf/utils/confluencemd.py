@@ -3,18 +3,85 @@ Confluence to Markdown utility
 """
 import os
 import re
+import copy
+import inspect
+import time
+import threading
 from  urllib import parse
-from typing import List, Tuple
-import requests
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 import atlassian
+from atlassian.rest_client import AtlassianRestAPI
+from requests import HTTPError
 
 from .log import logger
-from .md2html import md_to_html
+from .md2html import MarkdownDocument, md_to_document
+from .transport import Transport
+from .links import LinkIndex, read_page_id, replace_page_links
+from .stats import timed
+from .cache import DigestStore, JsonStore, JiraIssueCache, Manifest, RenderCache, \
+    cache_dir, content_digest, file_digest
 
 ISSUE_PATTERN_KEY = re.compile(r"\[(?P<key>\w[\w\d]*-\d+)\]")
 ISSUE_PATTERN_URL = re.compile(r"[^\"](?P<url>(?P<domain>https:\/\/\w+\.atlassian\.net)"
                                r"\/browse\/(?P<key>\w[\w\d]*-\d+))")
+ISSUE_PATTERN_ANY = re.compile(r"(?<=[^\"])(?:\[\w[\w\d]*-\d+\]"
+                               r"|https:\/\/\w+\.atlassian\.net\/browse\/\w[\w\d]*-\d+)")
+ATTACHMENT_DIGEST = "confluence.md sha256:{digest}"
+ATTACHMENTS_PAGE_SIZE = 200
+JIRA_KEYS_PER_SEARCH = 100
+JIRA_ISSUE_FIELDS = "summary,status,issuetype"
+PAGE_EXPAND = "version,space,children.attachment.metadata"
+PAGES_PER_LOOKUP = 200
+TITLES_PER_SEARCH = 50
+
+
+def replace_issue_links(html: str, links: Dict[str, str]) -> str:
+    """Replaces every `[KEY-ID]` or issue URL found in `links` (and not preceded by `"`)
+       with its html link, scanning the html only once. Adjacent references are all replaced,
+       issue keys in inserted summaries are left as text (no links nested in links)"""
+    if not links:
+        return html
+    return ISSUE_PATTERN_ANY.sub(lambda match: links.get(match.group(), match.group()), html)
+
+
+def cql_string(value: str) -> str:
+    """Returns value quoted as CQL string"""
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def client_retry_options() -> Dict[str, bool]:
+    """Returns keywords disabling retries of the Atlassian client, so Transport's scheduler is
+       the only retry layer. Older atlassian-python-api versions don't know (and don't do) them"""
+    parameters = inspect.signature(AtlassianRestAPI.__init__).parameters
+    return {name: False for name in ["backoff_and_retry", "retry_with_header"]
+            if name in parameters}
+
+
+def cql_id(value: str) -> str:
+    """Returns page id to put in CQL as is, it must be numeric"""
+    value = str(value).strip()
+    assert value.isdigit(), f"Invalid page id `{value}`"
+    return value
+
+
+def collect_attachments(attachments: dict, response: dict, start: int) -> Optional[int]:
+    """Adds attachments listed in one response (page starting at `start`) by file name,
+       returns start of the next page or None after the last one"""
+    for attachment in response.get("results", []):
+        attachments[attachment["title"]] = attachment
+    if response.get("size", 0) < ATTACHMENTS_PAGE_SIZE:
+        return None
+    return start + ATTACHMENTS_PAGE_SIZE
+
+
+def attachment_digest(attachment: dict) -> Optional[str]:
+    """Returns sha256 stored in the attachment comment on upload, None if there's none"""
+    comment = attachment.get("metadata", {}).get("comment") or ""
+    return comment.split("sha256:")[-1] if "sha256:" in comment else None
+
 
 class ConfluenceMD(atlassian.Confluence):
     """Confluence to Markdown utility class"""
@@ -24,7 +91,7 @@ class ConfluenceMD(atlassian.Confluence):
     def __init__(
         self,
         username: str,
-        md_file: str,
+        md_file: Optional[str] = None,
         token: str = '',
         password: str = '',
         url: str = None,
@@ -32,12 +99,26 @@ class ConfluenceMD(atlassian.Confluence):
         add_meta: bool = False,
         add_info_panel: bool = False,
         add_label: str = None,
-        convert_jira: bool = True
+        convert_jira: bool = True,
+        force_update: bool = False,
+        digest_file: Optional[str] = None,
+        max_parallel_uploads: int = 4,
+        jira_cache: bool = True,
+        refresh_jira_cache: bool = False,
+        jira_cache_ttl: int = 24 * 3600,
+        license_cache_ttl: int = 24 * 3600,
+        render_cache: bool = True,
+        transport: Optional[Transport] = None,
+        manifest_file: Optional[str] = None,
+        plan=None,
+        md_text: Optional[str] = None
     ) -> None:
         if url:
             self.jira_url = parse.urljoin(url, '/')
             self.conf_url = parse.urljoin(url, '/wiki/')
 
+        self.transport = transport or Transport(verify_ssl=verify_ssl)
+        self.stats = self.transport.run_stats
         super().__init__(
             url=self.conf_url or "",
             username=username,
@@ -45,162 +126,498 @@ class ConfluenceMD(atlassian.Confluence):
             verify_ssl=verify_ssl,
             cloud=bool(token),
             token=token,
+            session=self.transport.session,
+            timeout=self.transport.timeout,
+            **client_retry_options(),
         )
 
-        self.license = self.__init_jira(
+        self.__init_jira(
                 url=self.jira_url,
                 username=username,
                 password=(password or token),
                 verify_ssl=verify_ssl,
                 token=token
             )
+        self.auth = (username, password or token)
+        self.licenses = {}
+        self.licenses_lock = threading.Lock()
+        self.license_cache = JsonStore(os.path.join(cache_dir(), "license.json"))
+        self.license_cache_ttl = license_cache_ttl
         self.md_file = md_file
+        self.md_text = md_text
         self.add_meta = add_meta
         self.add_info_panel = add_info_panel
         self.add_label = add_label
-        self.md_file_dir = os.path.dirname(md_file)
+        self.md_file_dir = os.path.dirname(md_file) if md_file else ""
         self.convert_jira = convert_jira
+        self.force_update = force_update
+        self.max_parallel_uploads = max_parallel_uploads
+        self.jira_cache = JiraIssueCache(ttl=jira_cache_ttl) if jira_cache else None
+        self.refresh_jira_cache = refresh_jira_cache
+        self.render_cache = RenderCache() if render_cache else None
+        self.digests = DigestStore(digest_file)
+        self.manifest = Manifest(manifest_file) if manifest_file else None
+        self.plan = plan
+        self.remote_pages = {}
+        self.page_index = {}
+        self.space_titles = {}
+        self.link_index = LinkIndex()
+        if self.manifest and self.conf_url:
+            self.link_index.seed_manifest(self.manifest, self.conf_url)
+
+    def for_file(self, md_file: str) -> "ConfluenceMD":
+        """Returns a copy bound to another markdown file. The copy shares HTTP session,
+           Jira client and license with this instance, so no new connections are made"""
+        conf_md = copy.copy(self)
+        conf_md.md_file = md_file
+        conf_md.md_text = None
+        conf_md.md_file_dir = os.path.dirname(md_file)
+        return conf_md
 
     def __init_jira(self,
                     url: str,
                     username: str,
                     password: str,
                     verify_ssl: bool,
-                    token: str) -> bool:
+                    token: str) -> None:
         self.jira = atlassian.Jira(
                 url=url,
                 username=username,
                 password=(password or token),
                 verify_ssl=verify_ssl,
                 cloud=bool(token),
-                token=token
+                token=token,
+                session=self.transport.session,
+                timeout=self.transport.timeout,
+                **client_retry_options(),
             )
+
+    @property
+    def license(self) -> bool:
+        """Secure Markdown for Confluence license state. Checked on first use only,
+           the result is cached on disk for `license_cache_ttl` seconds"""
+        with self.licenses_lock:
+            if self.jira_url not in self.licenses:
+                self.licenses[self.jira_url] = self.__get_license()
+            return self.licenses[self.jira_url]
+
+    def __get_license(self) -> bool:
+        cached = self.license_cache.get(self.jira_url)
+        if cached and time.time() - cached["checked"] < self.license_cache_ttl:
+            logger.debug("Using cached Secure Markdown license state for %s", self.jira_url)
+            return cached["active"]
+
+        active = self.__check_license()
+        if active is None:
+            return False
+        self.license_cache.set(self.jira_url, {"active": active, "checked": time.time()})
+        return active
+
+    def __check_license(self) -> Optional[bool]:
+        """Returns license state, False if the app isn't installed, or None if it
+           couldn't be determined (and shouldn't be cached)"""
         try:
-            uri = parse.urljoin(url, 'wiki/rest/atlassian-connect/1/addons/secure-markdown-for-confluence')
-            res = requests.get(uri, auth=(username, password or token), timeout=30)
-            license_obj = res.json()
-            if res.status_code != 200:
+            uri = parse.urljoin(self.jira_url, 'wiki/rest/atlassian-connect/1/addons/secure-markdown-for-confluence')
+            res = self.transport.session.get(uri, auth=self.auth,
+                                             timeout=min(30, self.transport.timeout))
+            if res.status_code == 404:
                 return False
+            if res.status_code != 200:
+                logger.debug("Unable to check Secure Markdown license: HTTP %i", res.status_code)
+                return None
+            license_obj = res.json()
             return bool (license_obj["license"]["active"])
         # pylint: disable=broad-exception-caught
-        except (RuntimeError, AssertionError, Exception):
-            return False
-
-    def update_existing(self, page_id: str = None) -> int:
-        """Updates an existing page by given page_id"""
+        except (RuntimeError, AssertionError, Exception) as error:
+            logger.debug("Unable to check Secure Markdown license: %s", error)
+            return None
+
+    @timed("convert")
+    def convert(self) -> MarkdownDocument:
+        """Reads and converts `md_file` (or given `md_text`) to html"""
+        return md_to_document(self.md_file, self.add_info_panel, self.md_text, self.render_cache)
+
+    def update_existing(self, page_id: str = None,
+                        document: Optional[MarkdownDocument] = None) -> int:
+        """Updates an existing page by given page_id. Already converted document
+           can be given to avoid converting the markdown file again"""
         logger.debug("Updating page `%s` based on `md_file` file", page_id)
-        html, page_id_from_meta, url, images = md_to_html(self.md_file, self.add_info_panel)
-        if self.conf_url is None:
-            logger.debug("Using URL (%s) from `%s` file", url, self.md_file)
-            assert url, (
-                f"Can't update page without url given either by "
-                f"`--url` parameter or via `confluence-url` tag in `{self.md_file}` file`"
-            )
-            self.jira_url = parse.urljoin(url, '/')
-            self.conf_url = parse.urljoin(url, '/wiki/')
-            self.url = self.conf_url # to satisfy parent class
-
-        html = self.__rewrite_issues(html)
+        document = document or self.convert()
+        html, page_id_from_meta, images = document.html, document.page_id, document.images
+        self.use_document_url(document)
+        html = self.rewrite_links(self.rewrite_issues(html))
         if page_id is None:
             logger.debug("Using `page_id` from `%s` file", self.md_file)
             page_id = page_id_from_meta
 
-        self.__attach_images(page_id, images)
-
         assert page_id, (
             f"Can't update page without page_id given either by "
             f"`--page_id` parameter or via `confluence-url` tag in `{self.md_file}` file"
         )
 
+        entry = self.manifest_entry(page_id)
+        title = entry["title"] if entry else self.__get_page_title_by_id(page_id)
+        digest = self.page_digest(title, html, images)
+        if self.is_up_to_date(page_id, digest):
+            logger.info("Page `%s` is up to date with `%s`, skipping", title, self.md_file)
+            self.stats.count("pages_skipped")
+            self.link_index.add(self.md_file, page_id)
+            if self.plan is not None:
+                self.plan.add(self.md_file, "skip", page_id, title, "unchanged since last push")
+            return page_id
+
+        if self.plan is not None:
+            self.__plan_update(page_id, title, html, images, entry)
+            return page_id
 
-        title = self.__get_page_title_by_id(page_id)
+        attachments = self.__attach_images(page_id, images, known=entry)
 
         logger.debug("Updating page_id `%s` titled `%s`", page_id, title)
-        response = self.update_page(
-            page_id,
-            title,
-            html,
-            parent_id=None,
-            type="page",
-            representation="storage",
-            minor_edit=True,
-        )
+        response = self.__update_page(page_id, title, html, entry)
 
         if self.add_meta:
             confluence_url = ConfluenceMD.__get_link_from_response(response)
-            self.__add_meta_to_file(confluence_url)
+            self.add_meta_to_file(document, confluence_url)
 
         if self.add_label:
             self.__add_label_to_page(page_id)
 
+        self.store_digest(page_id, digest)
+        self.__record(response, digest, attachments, entry)
+        self.link_index.add(self.md_file, page_id)
+        self.stats.count("pages_updated")
         return page_id
 
-    def create_new(self, parent_id: str, title: str, overwrite: bool) -> int:
-        """Creates a new page under give parent_id"""
+    def use_document_url(self, document: MarkdownDocument) -> None:
+        """Takes Confluence and Jira URLs from document metadata if no `url` was given"""
+        if self.conf_url is not None:
+            return
+        url = document.url
+        logger.debug("Using URL (%s) from `%s` file", url, self.md_file)
+        assert url, (
+            f"Can't update page without url given either by "
+            f"`--url` parameter or via `confluence-url` tag in `{self.md_file}` file`"
+        )
+        self.jira_url = parse.urljoin(url, '/')
+        self.conf_url = parse.urljoin(url, '/wiki/')
+        self.url = self.conf_url # to satisfy parent class
+
+    def create_new(self, parent_id: str, title: str, overwrite: bool,
+                   document: Optional[MarkdownDocument] = None) -> int:
+        """Creates a new page under give parent_id. Already converted document
+           can be given to avoid converting the markdown file again"""
         assert title, "Provide a title for a newly created page"
         assert parent_id, "Provide parent_id for a newly created page"
-        space = self.get_page_space(parent_id)
-
+        entry = self.manifest_entry()
         page_id = None
-        if self.page_exists(space, title):
-            page_id = self.get_page_id(space, title)
-            assert overwrite, (
-                f"Page titled `{title}` already exists in "
-                f"the `{space}` space. Use `--overwrite` to force it."
-            )
-
-        html, page_id_from_meta, _url, images = md_to_html(self.md_file, self.add_info_panel)
-        html = self.__rewrite_issues(html)
-        assert not page_id_from_meta or overwrite, (
+        if entry and entry["title"] == title:
+            logger.debug("Page `%s` published from `%s` before", title, self.md_file)
+            space, page_id = entry["space"], entry["page_id"]
+        else:
+            entry = None
+            space, page = self.lookup_page(parent_id, title)
+            if page:
+                page_id = page["id"]
+                assert overwrite, (
+                    f"Page titled `{title}` already exists in "
+                    f"the `{space}` space. Use `--overwrite` to force it."
+                )
+
+        document = document or self.convert()
+        html, page_id_from_meta, images = document.html, document.page_id, document.images
+        html = self.rewrite_links(self.rewrite_issues(html))
+        assert not page_id_from_meta or overwrite or entry, (
             f"Metadata pointing to an existing page "
             f"id `{page_id_from_meta}` present in the given markdown file. "
             f"Use `--overwrite` to force it."
         )
 
         overwrite_id = page_id if page_id else page_id_from_meta
+        digest = self.page_digest(title, html, images)
+
+        if overwrite_id and self.is_up_to_date(overwrite_id, digest):
+            logger.info("Page `%s` is up to date with `%s`, skipping", title, self.md_file)
+            self.stats.count("pages_skipped")
+            self.link_index.add(self.md_file, overwrite_id)
+            if self.plan is not None:
+                self.plan.add(self.md_file, "skip", overwrite_id, title,
+                              "unchanged since last push")
+            return overwrite_id
+
+        if self.plan is not None:
+            if overwrite_id:
+                entry = entry if entry and entry["page_id"] == overwrite_id else None
+                self.__plan_update(overwrite_id, title, html, images, entry)
+            else:
+                uploads = self.get_uploads(None, images, {})
+                self.plan.add(self.md_file, "create", None, title, f"new page in `{space}`",
+                              [upload[2] for upload in uploads],
+                              len(html.encode("utf-8")) + ConfluenceMD.__upload_size(uploads))
+            return overwrite_id
 
         if overwrite_id:
             logger.debug(
                 "Overwriting existing page `%s` based on `%s` file", title, self.md_file
             )
-            response = self.update_page(
-                overwrite_id,
-                title,
-                html,
-                parent_id=None,
-                type="page",
-                representation="storage",
-                minor_edit=True,
-            )
+            entry = entry if entry and entry["page_id"] == overwrite_id else None
+            attachments = self.__attach_images(overwrite_id, images, known=entry)
+            response = self.__update_page(overwrite_id, title, html, entry)
         else:
             logger.debug("Creating new page `%s` based on `%s` file", title, self.md_file)
-            response = atlassian.Confluence.create_page(
-                self,
-                space,
-                title,
-                body=html,
-                parent_id=parent_id,
-                type="page",
-                representation="storage",
-                editor="v2",
-            )
+            with self.stats.stage("create_page"):
+                response = atlassian.Confluence.create_page(
+                    self,
+                    space,
+                    title,
+                    body=html,
+                    parent_id=parent_id,
+                    type="page",
+                    representation="storage",
+                    editor="v2",
+                )
+            self.index_new_page(parent_id, space, title, response)
+            attachments = {}
             if images:
                 logger.debug("Uploading images to newly created page")
                 page_id = ConfluenceMD.__get_page_id_from_response(response)
-                self.__attach_images(page_id, images)
+                attachments = self.__attach_images(page_id, images, new_page=True)
 
         confluence_url = ConfluenceMD.__get_link_from_response(response)
         logger.debug(
             "%s %s", 'Page overwritten' if overwrite_id else 'New page created', confluence_url
         )
 
-        self.__add_meta_to_file(confluence_url)
+        self.add_meta_to_file(document, confluence_url)
 
         page_id = ConfluenceMD.__get_page_id_from_response(response)
         self.__add_label_to_page(page_id)
+        self.store_digest(page_id, digest)
+        self.__record(response, digest, attachments, entry)
+        self.link_index.add(self.md_file, page_id)
+        self.stats.count("pages_updated" if overwrite_id else "pages_created")
         return page_id
 
-    def __rewrite_issues(self, html):
+    def stats_report(self) -> dict:
+        """Returns stats of this run together with HTTP and cache stats"""
+        caches = {name: {"hits": cache.hits, "misses": cache.misses}
+                  for (name, cache) in [("jira", self.jira_cache), ("render", self.render_cache)]
+                  if cache}
+        return self.stats.report(http=self.transport.stats(), caches=caches)
+
+    def lookup_page(self, parent_id: str, title: str) -> Tuple[str, Optional[dict]]:
+        """Returns space of the parent page and the page titled `title` in that space
+           (if it exists), or from children of the parent indexed by `index_children`.
+           The parent is read directly, search may not know about a just created page"""
+        index = self.page_index.get(parent_id)
+        if index is not None:
+            if title in index["titles"]:
+                return index["space"], index["titles"][title]
+            if (index["space"], title) in self.space_titles:
+                return index["space"], self.space_titles[(index["space"], title)]
+            pages = self.__search(f"space = {cql_string(index['space'])} and type = page "
+                                  f"and title = {cql_string(title)}")
+            return index["space"], pages[0] if pages else None
+
+        space = self.__parent_space(parent_id)
+        pages = self.__search(f"space = {cql_string(space)} and type = page "
+                              f"and title = {cql_string(title)}")
+        return space, pages[0] if pages else None
+
+    def index_children(self, parent_id: str, titles: Iterable[str] = ()) -> None:
+        """Reads the parent page and all its children in one paginated search, so
+           `lookup_page` doesn't need a request for pages already under the parent.
+           Pages with given titles are looked up anywhere in the space by `index_titles`"""
+        pages = self.__search(f"id = {cql_id(parent_id)} or parent = {cql_id(parent_id)}")
+        space = self.__parent_space(parent_id, pages)
+        children = {page["title"]: page for page in pages if page["id"] != str(parent_id)}
+        self.page_index[parent_id] = {"space": space, "titles": children}
+        self.space_titles.update({(space, title): page for (title, page) in children.items()})
+        logger.debug("%i page(s) found under `%s`", len(children), parent_id)
+        self.index_titles(space, titles)
+
+    def index_titles(self, space: str, titles: Iterable[str]) -> None:
+        """Looks up pages with given titles in the space, TITLES_PER_SEARCH per search,
+           so `lookup_page` knows whether they exist without a search per page"""
+        titles = [title for title in dict.fromkeys(titles)
+                  if (space, title) not in self.space_titles]
+        for start in range(0, len(titles), TITLES_PER_SEARCH):
+            chunk = titles[start:start + TITLES_PER_SEARCH]
+            pages = self.__search(f"space = {cql_string(space)} and type = page "
+                                  f"and title in ({', '.join(map(cql_string, chunk))})")
+            self.space_titles.update({(space, title): None for title in chunk})
+            self.space_titles.update({(space, page["title"]): page for page in pages})
+
+    def index_descendants(self, parent_id: str, titles: Iterable[str] = ()) -> None:
+        """Reads the parent page and its whole subtree in one paginated search and
+           indexes every page by its direct parent, same as `index_children`. Pages
+           with given titles are looked up anywhere in the space, the first
+           TITLES_PER_SEARCH in the same search and the rest by `index_titles`"""
+        cql = f"id = {cql_id(parent_id)} or ancestor = {cql_id(parent_id)}"
+        titles = sorted(set(titles))
+        first = titles[:TITLES_PER_SEARCH]
+        if first:
+            cql += f" or (type = page and title in ({', '.join(map(cql_string, first))}))"
+        pages = self.__search(cql, expand="space,version,ancestors")
+        space = self.__parent_space(parent_id, pages)
+        self.space_titles.update({(space, title): None for title in first})
+        self.space_titles.update({(space, page["title"]): page for page in pages
+                                  if page["space"]["key"] == space})
+        pages = [page for page in pages if page["id"] == str(parent_id) or str(parent_id)
+                 in [ancestor["id"] for ancestor in page.get("ancestors", [])]]
+        self.page_index.setdefault(parent_id, {"space": space, "titles": {}})
+        for page in pages:
+            self.page_index.setdefault(page["id"], {"space": space, "titles": {}})
+            if page["id"] != str(parent_id) and page.get("ancestors"):
+                direct_parent = page["ancestors"][-1]["id"]
+                self.page_index.setdefault(direct_parent, {"space": space, "titles": {}})
+                self.page_index[direct_parent]["titles"][page["title"]] = page
+        logger.debug("%i page(s) found below `%s`", len(pages) - 1, parent_id)
+        self.index_titles(space, titles[TITLES_PER_SEARCH:])
+
+    def index_new_page(self, parent_id: str, space: str, title: str, page: dict) -> None:
+        """Adds just created page to the index, under its parent and as a parent
+           without children, so looking up its children needs no search"""
+        if parent_id in self.page_index:
+            self.page_index[parent_id]["titles"][title] = page
+        self.page_index.setdefault(page["id"], {"space": space, "titles": {}})
+        self.space_titles[(space, title)] = page
+
+    def __parent_space(self, parent_id: str, pages: Iterable[dict] = ()) -> str:
+        """Returns space of the parent page from search results, or reads the page
+           if search doesn't return it (yet, the search index lags behind)"""
+        parents = [page for page in pages if page["id"] == str(parent_id)]
+        if parents:
+            return parents[0]["space"]["key"]
+        parent = self.get_page_by_id(cql_id(parent_id), expand="space")
+        assert parent, f"Parent page `{parent_id}` not found"
+        return parent["space"]["key"]
+
+    def __search(self, cql: str, expand: str = "space,version") -> List[dict]:
+        """Returns all pages matching CQL query, with space and version"""
+        pages = []
+        start = 0
+        while True:
+            response = self.get("rest/api/content/search",
+                                params={"cql": cql, "expand": expand,
+                                        "start": start, "limit": PAGES_PER_LOOKUP})
+            results = (response or {}).get("results", [])
+            pages.extend(results)
+            if len(results) < PAGES_PER_LOOKUP:
+                return pages
+            start += len(results)
+
+    def __plan_update(self, page_id: str, title: str, html: str,
+                      images: List[Tuple[str, str]], entry: Optional[dict]) -> None:
+        """Records update in the plan, called when the page isn't up to date with the digest
+           of the last push. Remote body isn't compared, Confluence normalizes storage format"""
+        page = self.__get_page(page_id)
+        existing = self.__get_existing_attachments(page_id, images, known=entry, page=page)
+        uploads = self.get_uploads(page_id, images, existing)
+        if self.force_update:
+            reason = "forced update"
+        elif self.last_digest(page_id):
+            reason = "content changed since last push"
+        else:
+            reason = "not pushed from here before"
+        self.plan.add(self.md_file, "update", page_id, title, reason,
+                      [upload[2] for upload in uploads],
+                      len(html.encode("utf-8")) + ConfluenceMD.__upload_size(uploads))
+
+    @staticmethod
+    def __upload_size(uploads: List[tuple]) -> int:
+        return sum(os.path.getsize(upload[1]) for upload in uploads)
+
+    def __get_page(self, page_id: str) -> dict:
+        """Returns page with version and attachments, prefetched ones are reused"""
+        if page_id not in self.remote_pages:
+            self.remote_pages[page_id] = self.get_page_by_id(page_id, expand=PAGE_EXPAND)
+        return self.remote_pages[page_id]
+
+    @timed("update_page")
+    def __update_page(self, page_id: str, title: str, html: str, entry: Optional[dict]) -> dict:
+        """Puts next page version straight away if the last pushed version is known
+           from the manifest, falls back to regular update if the page changed since"""
+        if entry and entry.get("version") and not self.force_update:
+            try:
+                return self.put(f"rest/api/content/{page_id}", data={
+                    "id": page_id, "type": "page", "title": title,
+                    "body": {"storage": {"value": html, "representation": "storage"}},
+                    "version": {"number": entry["version"] + 1, "minorEdit": True}})
+            except HTTPError as error:
+                if error.response is None or error.response.status_code != 409:
+                    raise
+                logger.debug("Page `%s` changed since last push, updating latest version",
+                             page_id)
+
+        return self.update_page(
+            page_id,
+            title,
+            html,
+            parent_id=None,
+            type="page",
+            representation="storage",
+            minor_edit=True,
+            always_update=self.force_update,
+        )
+
+    @contextmanager
+    def manifest_batch(self) -> Iterator[None]:
+        """Writes the manifest once at the end of the block, not after every page"""
+        if self.manifest is None:
+            yield
+            return
+        with self.manifest.batch():
+            yield
+
+    def manifest_entry(self, page_id: Optional[str] = None) -> Optional[dict]:
+        """Returns manifest state of `md_file` if it was published to given page
+           (or any page) of this Confluence instance"""
+        if self.manifest is None or self.md_text is not None:
+            return None
+        entry = self.manifest.get(self.md_file)
+        if not entry or entry.get("url") != self.conf_url:
+            return None
+        if page_id is not None and entry.get("page_id") != page_id:
+            return None
+        return entry
+
+    def __record(self, response: dict, digest: str, attachments: Dict[str, dict],
+                 entry: Optional[dict]) -> None:
+        """Records page state in the manifest"""
+        if self.manifest is None or self.md_text is not None:
+            return
+        page_id = ConfluenceMD.__get_page_id_from_response(response)
+        known = entry["attachments"] if entry and entry["page_id"] == page_id else {}
+        self.manifest.set(self.md_file, {
+            "url": self.conf_url,
+            "page_id": page_id,
+            "title": response["title"],
+            "space": response.get("space", {}).get("key") or (entry or {}).get("space"),
+            "version": response.get("version", {}).get("number"),
+            "digest": digest,
+            "attachments": {**known, **attachments}})
+
+    @timed("links")
+    def rewrite_links(self, html: str) -> str:
+        """Replaces links to other markdown files with links to their pages. Files linking
+           to files without a page yet are remembered in `link_index` to update them later"""
+        html, unresolved = replace_page_links(html, self.md_file or "", self.__resolve_link)
+        if unresolved:
+            logger.debug("%i linked file(s) have no page yet", len(unresolved))
+        self.link_index.defer(self.md_file or "", unresolved)
+        return html
+
+    def __resolve_link(self, md_file: str) -> Optional[str]:
+        page_id = self.link_index.get(md_file) or read_page_id(md_file)
+        return self.page_url(page_id) if page_id else None
+
+    def page_url(self, page_id: str) -> str:
+        """Returns URL of page with given id"""
+        return f"{self.conf_url}pages/viewpage.action?pageId={page_id}"
+
+    @timed("jira")
+    def rewrite_issues(self, html: str) -> str:
+        """Replaces Jira links with issue snippets if `convert_jira` is on"""
         if self.convert_jira:
             logger.debug("Replacing [ISSUE-KEY] with html links")
 
@@ -217,7 +634,10 @@ class ConfluenceMD(atlassian.Confluence):
                                 issue.group("domain"),
                                 self.jira_url)
 
-        if issues and not self.convert_jira:
+        if not issues:
+            return html
+
+        if not self.convert_jira:
             (replace, key) = issues[0]
             logger.info("Use `--convert_jira` to replace %i Jira link(s) (such as %s) "
                         "with issue snippets - KEY: summary [status]",
@@ -230,45 +650,223 @@ class ConfluenceMD(atlassian.Confluence):
             logger.warning("Server/data-center: https://dirtyagile.atlassian.net/wiki/x/AQACR")
             return html
 
+        resolved = self.__get_jira_issues(list(dict.fromkeys(key for (_replace, key) in issues)))
+        links = {}
         for (replace, key) in issues:
-            logger.debug("  - [%s] with html link", key)
-            (summary, status, issuetypeurl) = self.__get_jira_issue(key)
-            if summary:
-                re_replace = re.compile(r"([^\"])" + re.escape(replace))
-                html = re.sub(re_replace,
-                    f"\\1<a href=\"{self.jira_url}browse/{key}\"><ac:image>"
-                    f"<ri:url ri:value=\"{issuetypeurl}\" />"
-                    f"</ac:image> {key}: {summary} [{status}]</a>",
-                    html)
-        return html
+            (summary, status, issuetypeurl) = resolved.get(key, (None, None, None))
+            if summary and replace not in links:
+                logger.debug("  - [%s] with html link", key)
+                links[replace] = (f"<a href=\"{self.jira_url}browse/{key}\"><ac:image>"
+                                  f"<ri:url ri:value=\"{issuetypeurl}\" />"
+                                  f"</ac:image> {key}: {summary} [{status}]</a>")
+        return replace_issue_links(html, links)
+
+    def __get_jira_issues(self, keys: List[str]) -> dict:
+        """Resolves unique issue keys from the local cache first, then with paginated
+           `key in (...)` JQL searches, falls back to one request per key if search fails"""
+        cached = {}
+        if self.jira_cache and not self.refresh_jira_cache:
+            cached = self.jira_cache.get_many(self.jira_url, keys)
+            logger.debug("%i of %i Jira issue(s) found in cache", len(cached), len(keys))
+            keys = [key for key in keys if key not in cached]
+
+        resolved = {}
+        for chunk_start in range(0, len(keys), JIRA_KEYS_PER_SEARCH):
+            chunk = keys[chunk_start:chunk_start + JIRA_KEYS_PER_SEARCH]
+            try:
+                start = 0
+                while True:
+                    response = self.jira.jql(f"key in ({','.join(chunk)})",
+                                             fields=JIRA_ISSUE_FIELDS,
+                                             start=start,
+                                             limit=JIRA_KEYS_PER_SEARCH,
+                                             validate_query="warn")
+                    for issue in response.get("issues", []):
+                        resolved[issue["key"]] = ConfluenceMD.__get_jira_issue_fields(issue)
+                    start += len(response.get("issues", []))
+                    if not response.get("issues") or start >= response.get("total", 0):
+                        break
+            # pylint: disable=broad-exception-caught
+            except (RuntimeError, AssertionError, Exception) as error:
+                logger.debug("Jira search failed (%s), getting issues one by one", error)
+                for key in chunk:
+                    resolved[key] = self.__get_jira_issue(key)
+
+        for key in keys:
+            if key not in resolved:
+                logger.info("Unable to convert %s to Jira link: issue not found", key)
+        if self.jira_cache:
+            self.jira_cache.put_many(self.jira_url, resolved)
+        resolved.update(cached)
+        return resolved
 
     def __get_jira_issue(self, key: str) -> tuple:
         try:
-            issue = self.jira.issue(key)
-            summary = issue['fields']['summary']
-            status = issue['fields']['status']['name']
-            issuetypeurl = issue['fields']['issuetype']['iconUrl']
-            return (summary, status, issuetypeurl)
+            return ConfluenceMD.__get_jira_issue_fields(
+                self.jira.issue(key, fields=JIRA_ISSUE_FIELDS))
         # pylint: disable=broad-exception-caught
         except (RuntimeError, AssertionError, Exception) as error:
             logger.info("Unable to convert %s to Jira link: %s", key, error)
             return (None, None, None)
 
-    def __attach_images(
-            self, page_id: str, images: List[Tuple[str, str]]
-    ) -> None:
-        """Replaces <img> html tags with Confluence specific <ac:image> and uploads
-           images as attachments"""
+    @staticmethod
+    def __get_jira_issue_fields(issue: dict) -> tuple:
+        """Returns (summary, status, issue type icon url) of Jira issue"""
+        summary = issue['fields']['summary']
+        status = issue['fields']['status']['name']
+        issuetypeurl = issue['fields']['issuetype']['iconUrl']
+        return (summary, status, issuetypeurl)
+
+    @timed("attachments")
+    def __attach_images(self, page_id: str, images: List[Tuple[str, str]],
+                        new_page: bool = False, known: Optional[dict] = None) -> Dict[str, dict]:
+        """Uploads images as attachments, skipping the ones already attached
+           with the same size and digest. Attachments recorded in `known` manifest entry
+           are trusted instead of listing page attachments. Up to `max_parallel_uploads`
+           files are uploaded at once, failures are reported per file after all uploads
+           finish. Returns id, size and digest of every attached image by file name"""
+        existing = self.__get_existing_attachments(page_id, images, new_page, known)
+        uploads = self.get_uploads(page_id, images, existing)
+
+        attached = {}
+        for (_alt, path) in images:
+            name = os.path.basename(path)
+            if name in existing:
+                attached[name] = ConfluenceMD.__attachment_state(existing[name])
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(1, self.max_parallel_uploads)) as executor:
+            futures = [(upload[1], executor.submit(self.__upload_attachment, *upload))
+                       for upload in uploads]
+            for (rel_path, future) in futures:
+                try:
+                    response = future.result()
+                    attachment = (response or {}).get("results", [response])[0]
+                    attached[os.path.basename(rel_path)] = \
+                        ConfluenceMD.__attachment_state(attachment)
+                # pylint: disable=broad-exception-caught
+                except (RuntimeError, AssertionError, Exception) as error:
+                    logger.error("Unable to upload image file `%s`: %s", rel_path, error)
+                    errors.append(rel_path)
+
+        self.stats.count("images_uploaded", len(uploads) - len(errors))
+        self.stats.count("images_unchanged", len(images) - len(uploads))
+        if errors:
+            raise RuntimeError(f"Failed to upload {len(errors)} of {len(uploads)} image(s): "
+                               f"{', '.join(errors)}")
+        return attached
+
+    def __get_existing_attachments(self, page_id: str, images: List[Tuple[str, str]],
+                                   new_page: bool = False, known: Optional[dict] = None,
+                                   page: Optional[dict] = None) -> dict:
+        """Returns page attachments by file name, taken from manifest entry or from
+           attachments expanded in the page if complete, listed otherwise"""
+        if new_page or not images:
+            return {}
+        if known and not self.force_update:
+            return {name: {"id": attachment["id"],
+                           "extensions": {"fileSize": attachment["size"]},
+                           "metadata": {"comment": ATTACHMENT_DIGEST.format(
+                               digest=attachment["sha256"])}}
+                    for (name, attachment) in known.get("attachments", {}).items()}
+        expanded = (page or {}).get("children", {}).get("attachment")
+        if expanded and expanded.get("size", 0) < expanded.get("limit", 0):
+            return {attachment["title"]: attachment for attachment in expanded["results"]}
+        return self.__get_attachments(page_id)
+
+    @staticmethod
+    def __attachment_state(attachment: dict) -> dict:
+        """Returns manifest state of attachment from Confluence API response"""
+        return {"id": attachment.get("id"),
+                "size": attachment.get("extensions", {}).get("fileSize"),
+                "sha256": attachment_digest(attachment)}
+
+    def get_uploads(self, page_id: str, images: List[Tuple[str, str]],
+                    existing: dict) -> List[Tuple[str, str, str, str, Optional[str]]]:
+        """Returns (page_id, path, name, comment, attachment_id) of images to upload,
+           given existing page attachments by file name"""
+        uploads = {}
         for (_alt, path) in images:
-            rel_path = os.path.join(self.md_file_dir, path)
-            if not os.path.isfile(rel_path):
-                assert os.path.isfile(path), f"File `{path}` does not exist"
-                logger.warning("File `%s` does not exist, using file relative "
-                               "to current dir `%s`", rel_path, path)
-                rel_path = path
+            rel_path = self.get_image_path(path)
+            name = os.path.basename(rel_path)
+            if name in uploads:
+                continue
+
+            digest = file_digest(rel_path)
+            attachment = existing.get(name)
+            if attachment and \
+                    attachment.get("extensions", {}).get("fileSize") == os.path.getsize(rel_path) and \
+                    attachment_digest(attachment) == digest:
+                logger.debug("image file `%s` already attached, skipping", rel_path)
+                uploads[name] = None
+                continue
 
             logger.debug("register image file `%s`", rel_path)
-            self.attach_file(filename=rel_path, page_id=page_id)
+            uploads[name] = (page_id, rel_path, name, ATTACHMENT_DIGEST.format(digest=digest),
+                             attachment["id"] if attachment else None)
+        return [upload for upload in uploads.values() if upload]
+
+    def __get_attachments(self, page_id: str) -> dict:
+        """Returns all page attachments by file name"""
+        attachments = {}
+        start = 0
+        while start is not None:
+            start = collect_attachments(attachments, self.get_attachments_from_content(
+                page_id, start=start, limit=ATTACHMENTS_PAGE_SIZE), start)
+        return attachments
+
+    def __upload_attachment(self, page_id: str, path: str, name: str, comment: str,
+                            attachment_id: Optional[str]) -> dict:
+        """Uploads new attachment or new version of an existing one. Same as `attach_file`,
+           but without looking up the existing attachment again"""
+        content_type = self.content_types.get(os.path.splitext(path)[-1], "application/binary")
+        url = f"rest/api/content/{page_id}/child/attachment"
+        if attachment_id:
+            url += f"/{attachment_id}/data"
+        with open(path, "rb") as stream:
+            return self.post(
+                path=url,
+                data={"type": "attachment", "fileName": name, "contentType": content_type,
+                      "comment": comment, "minorEdit": "true"},
+                headers={"X-Atlassian-Token": "no-check", "Accept": "application/json"},
+                files={"file": (name, stream, content_type)},
+            )
+
+    def get_image_path(self, path: str) -> str:
+        """Returns image path relative to markdown file, or to current dir as a fallback"""
+        rel_path = os.path.join(self.md_file_dir, path)
+        if not os.path.isfile(rel_path):
+            assert os.path.isfile(path), f"File `{path}` does not exist"
+            logger.warning("File `%s` does not exist, using file relative "
+                           "to current dir `%s`", rel_path, path)
+            rel_path = path
+        return rel_path
+
+    def page_digest(self, title: str, html: str, images: List[Tuple[str, str]]) -> str:
+        """Returns digest of everything that ends up on the page"""
+        image_digests = [f"{path}:{file_digest(self.get_image_path(path))}"
+                         for (_alt, path) in images]
+        return content_digest(title, html, self.add_label, *image_digests)
+
+    def __digest_key(self, page_id: str) -> str:
+        return f"{self.conf_url}{page_id}"
+
+    def is_up_to_date(self, page_id: str, digest: str) -> bool:
+        """Checks if page was last pushed with exactly the same content"""
+        if self.force_update:
+            return False
+        entry = self.manifest_entry(page_id)
+        return self.digests.get(self.__digest_key(page_id)) == digest or \
+            bool(entry and entry.get("digest") == digest)
+
+    def last_digest(self, page_id: str) -> Optional[str]:
+        """Returns digest of content last pushed to the page, from the manifest or cache"""
+        entry = self.manifest_entry(page_id)
+        return (entry or {}).get("digest") or self.digests.get(self.__digest_key(page_id))
+
+    def store_digest(self, page_id: str, digest: str) -> None:
+        """Remembers digest of content pushed to the page"""
+        self.digests.set(self.__digest_key(page_id), digest)
 
     @staticmethod
     def __get_link_from_response(response) -> str:
@@ -280,13 +878,18 @@ class ConfluenceMD(atlassian.Confluence):
         """Returns page_id from Confluence API response"""
         return response["id"]
 
-    def __add_meta_to_file(self, confluence_url: str) -> None:
+    def add_meta_to_file(self, document: MarkdownDocument, confluence_url: str) -> None:
         """Decorates markdown file with metadata in comments"""
         if not self.add_meta:
             return
+        if self.md_text is not None:
+            logger.warning("Markdown not read from a file, can't add metadata")
+            return
+        if "confluence-url" in document.metadata:
+            logger.debug("`%s` already points to a page, metadata not added", self.md_file)
+            return
 
-        markdown = ConfluenceMD.__get_file_contents(self.md_file)
-        markdown = ("---\n" f"confluence-url: {confluence_url}\n" "---\n") + markdown
+        markdown = ("---\n" f"confluence-url: {confluence_url}\n" "---\n") + document.text
 
         with open(self.md_file, "w", encoding="utf-8") as stream:
             stream.write(markdown)
@@ -294,19 +897,14 @@ class ConfluenceMD(atlassian.Confluence):
     def __get_page_title_by_id(self, page_id: str) -> str:
         """Returns page title by given page_id"""
         logger.debug("Getting page title from page id `%s`", page_id)
-        page = self.get_page_by_id(page_id)
+        page = self.remote_pages.get(page_id) or self.get_page_by_id(page_id)
         assert "title" in page, f"Expected page-object while getting page by id, got {page}"
         return page["title"]
 
-    @staticmethod
-    def __get_file_contents(file: str) -> str:
-        """Return file contents"""
-        with open(file, "r", encoding="utf-8") as stream:
-            return stream.read()
-
 
     def __add_label_to_page(self, page_id: str) -> None:
         """Self descriptive"""
         if not self.add_label:
             return
-        self.set_page_label(page_id, self.add_label)
+        with self.stats.stage("label"):
+            self.set_page_label(page_id, self.add_label)
@@ -0,0 +1,108 @@
+"""
+Converts markdown files to Confluence storage format without any network access
+"""
+import os
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from .log import logger
+from .cache import RenderCache, file_digest
+from .md2html import MarkdownDocument, md_to_document
+from .sync import convert_file, convert_pool_size
+
+EXPORT_MANIFEST = "export.json"
+
+
+def export_files(files: List[str],
+                 out_dir: Optional[str] = None,
+                 add_info_panel: bool = False,
+                 render_cache: bool = True,
+                 convert_workers: int = 0) -> List[dict]:
+    """Converts files to storage XHTML. With out_dir every file is written to
+       `out_dir/<path relative to the files' common dir>.html` and `export.json` lists
+       all files with their images. Returns one entry per file, failed files have `error`
+       set. Jira and cross-file links are left as written, resolving them needs Confluence"""
+    assert files, "No markdown files to export"
+    cache = RenderCache() if render_cache else None
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    base = os.path.commonpath([os.path.dirname(os.path.abspath(md_file)) for md_file in files])
+
+    pool_size = convert_pool_size(convert_workers, len(files))
+    if pool_size:
+        with ProcessPoolExecutor(max_workers=pool_size,
+                                 mp_context=multiprocessing.get_context("spawn")) as converters:
+            futures = [converters.submit(convert_file, md_file, add_info_panel,
+                                         cache.path if cache else None) for md_file in files]
+            documents = [__result(future) for future in futures]
+    else:
+        documents = [__convert(md_file, add_info_panel, cache) for md_file in files]
+
+    entries = []
+    for (md_file, document) in zip(files, documents):
+        entry = {"file": md_file, "title": os.path.splitext(os.path.basename(md_file))[0],
+                 "output": None, "page_id": None, "url": None, "images": [], "error": None}
+        try:
+            if isinstance(document, Exception):
+                raise document
+            entry.update(page_id=document.page_id, url=document.url,
+                         images=__image_manifest(md_file, document))
+            if out_dir:
+                entry["output"] = __write_html(document, out_dir, base)
+        # pylint: disable=broad-exception-caught
+        except (RuntimeError, AssertionError, Exception) as error:
+            logger.debug("Exporting `%s` failed: %s", md_file, error)
+            entry["error"] = str(error)
+        entry["html"] = document.html if not entry["error"] else None
+        entries.append(entry)
+
+    if out_dir:
+        manifest = os.path.join(out_dir, EXPORT_MANIFEST)
+        with open(manifest, "w", encoding="utf-8") as stream:
+            json.dump([{key: value for (key, value) in entry.items() if key != "html"}
+                       for entry in entries], stream, indent=1)
+        logger.info("Export to `%s` listed in `%s`", out_dir, manifest)
+    return entries
+
+
+def __convert(md_file: str, add_info_panel: bool, cache: Optional[RenderCache]):
+    """Returns converted document, or the error"""
+    try:
+        return md_to_document(md_file, add_info_panel, cache=cache)
+    # pylint: disable=broad-exception-caught
+    except (RuntimeError, AssertionError, Exception) as error:
+        return error
+
+
+def __result(future):
+    """Returns document converted in a worker process, or the error"""
+    try:
+        return future.result()[0]
+    # pylint: disable=broad-exception-caught
+    except (RuntimeError, AssertionError, Exception) as error:
+        return error
+
+
+def __image_manifest(md_file: str, document: MarkdownDocument) -> List[dict]:
+    """Returns images to attach: path as written, file found, attachment name, size and digest"""
+    images = []
+    for (alt, path) in document.images:
+        image_path = os.path.join(os.path.dirname(md_file), path)
+        if not os.path.isfile(image_path):
+            image_path = path
+        images.append({"alt": alt, "path": path, "file": image_path,
+                       "name": os.path.basename(image_path),
+                       "size": os.path.getsize(image_path), "sha256": file_digest(image_path)})
+    return images
+
+
+def __write_html(document: MarkdownDocument, out_dir: str, base: str) -> str:
+    """Writes storage XHTML next to where the file would be in out_dir, returns its path"""
+    relative = os.path.relpath(os.path.abspath(document.md_file), base)
+    output = os.path.join(out_dir, os.path.splitext(relative)[0] + ".html")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as stream:
+        stream.write(document.html)
+    return output
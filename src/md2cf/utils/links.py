@@ -0,0 +1,102 @@
+"""
+Links between markdown files rewritten to links between their pages
+"""
+import os
+import re
+import threading
+from urllib import parse
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .md2html import CF_URL
+
+LINK_PATTERN = re.compile(r'<a href="(?P<path>[^":?#]+\.md)(?P<anchor>#[^"]*)?"')
+FRONT_MATTER = re.compile(r"\A---\s*\n(?P<meta>.*?)\n---\s*\n", re.DOTALL)
+
+
+def read_page_id(md_file: str) -> Optional[str]:
+    """Returns page id from `confluence-url` front matter, without converting the file"""
+    try:
+        with open(md_file, "r", encoding="utf-8") as stream:
+            head = stream.read(4096)
+    except OSError:
+        return None
+    front_matter = FRONT_MATTER.match(head)
+    if not front_matter:
+        return None
+    for line in front_matter.group("meta").splitlines():
+        if line.startswith("confluence-url:"):
+            url = CF_URL.search(line)
+            return url.group("page_id") if url else None
+    return None
+
+
+def replace_page_links(html: str, md_file: str,
+                       resolve: Callable[[str], Optional[str]]) -> Tuple[str, List[str]]:
+    """Replaces relative links to markdown files with links returned by `resolve`
+       for the linked file. Returns html and linked files that couldn't be resolved"""
+    base = os.path.dirname(md_file)
+    unresolved = []
+
+    def replace(match: re.Match) -> str:
+        target = os.path.abspath(os.path.join(base, parse.unquote(match.group("path"))))
+        url = resolve(target)
+        if url is None:
+            if os.path.isfile(target):
+                unresolved.append(target)
+            return match.group()
+        return f'<a href="{url}{match.group("anchor") or ""}"'
+
+    return LINK_PATTERN.sub(replace, html), unresolved
+
+
+class LinkIndex:
+    """Source markdown file to page id of files published (or about to be published)
+       in one run, shared by all files. Remembers files linking to files without a page yet,
+       so their pages can be updated once the linked pages are created"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.pages: Dict[str, str] = {}
+        self.unresolved: Dict[str, List[str]] = {}
+
+    def add(self, md_file: str, page_id: str) -> None:
+        """Records page of given file"""
+        with self.lock:
+            self.pages[os.path.abspath(md_file)] = str(page_id)
+
+    def get(self, md_file: str) -> Optional[str]:
+        """Returns page id of given file"""
+        with self.lock:
+            return self.pages.get(os.path.abspath(md_file))
+
+    def seed(self, files: List[str]) -> None:
+        """Records pages of files with `confluence-url` front matter"""
+        for md_file in files:
+            page_id = read_page_id(md_file)
+            if page_id:
+                self.add(md_file, page_id)
+
+    def seed_manifest(self, manifest, conf_url: str) -> None:
+        """Records pages of files published to given Confluence according to the manifest"""
+        base = os.path.dirname(os.path.abspath(manifest.path))
+        for (key, entry) in manifest.entries().items():
+            if entry.get("url") == conf_url and entry.get("page_id"):
+                self.add(os.path.join(base, key), entry["page_id"])
+
+    def defer(self, md_file: str, targets: List[str]) -> None:
+        """Remembers files linked from given file that have no page yet"""
+        with self.lock:
+            if targets:
+                self.unresolved[os.path.abspath(md_file)] = targets
+            else:
+                self.unresolved.pop(os.path.abspath(md_file), None)
+
+    def pending(self) -> List[str]:
+        """Returns (and forgets) files linking to files that got a page since"""
+        with self.lock:
+            files = sorted(md_file for (md_file, targets) in self.unresolved.items()
+                           if md_file in self.pages
+                           and any(target in self.pages for target in targets))
+            for md_file in files:
+                del self.unresolved[md_file]
+            return files
@@ -3,14 +3,13 @@ confluence.md logging utility
 """
 import logging
 
-import coloredlogs
-from termcolor import colored
-
 logger = logging.getLogger("net.dirtyagile.confluence.md")
 
 
 def init_logger(args):
     """Inits logger based on commandline args"""
+    # pylint: disable=import-outside-toplevel
+    import coloredlogs
     coloredlogs.install(
             level='WARN' if args.quiet else ('DEBUG' if args.verbose else 'INFO'),
             logger=logger,
@@ -38,5 +37,7 @@ def init_logger(args):
 
 def headline(msg):
     """Bold headline"""
+    # pylint: disable=import-outside-toplevel
+    from termcolor import colored
     logger.info(colored(" {:80}".format(msg), 'blue',
             attrs=['reverse']))
@@ -3,43 +3,101 @@ Converts markdown to html
 """
 import re
 import os
+import json
 from typing import Any, List, Tuple, Optional, Dict
-import markdown2
 
 from .log import logger
+from .cache import RenderCache, content_digest, tool_version
 
 CF_URL = re.compile(r"(?P<host>https?://[^/]+)/.*/(?P<page_id>\d+)")
-IMAGE_PATTERN = re.compile(r"!\[(?P<alt>[^\]]*)\]\((?P<path>[^:]+)\)")
-
-
-def md_to_html(md_file: str,
-               add_info_panel: bool) -> Tuple[Any, Optional[str], Optional[str], List]:
-    """Converts given md_file to html"""
-
+IMAGE_PATTERN = re.compile(r"!\[(?P<alt>[^\]]*)\]\((?P<path>[^:)\n]+)\)")
+MD_EXTRAS = [
+    "metadata",
+    "strike",
+    "tables",
+    "wiki-tables",
+    "code-friendly",
+    "fenced-code-blocks",
+    "footnotes",
+]
+
+
+class MarkdownDocument:
+    """Markdown source read once, together with everything derived from it"""
+    # pylint: disable=too-few-public-methods,too-many-arguments
+
+    def __init__(self,
+                 md_file: str,
+                 text: str,
+                 html: str,
+                 metadata: Dict[str, str],
+                 images: List[Tuple[str, str]],
+                 page_id: Optional[str] = None,
+                 url: Optional[str] = None) -> None:
+        self.md_file = md_file
+        self.text = text
+        self.html = html
+        self.metadata = metadata
+        self.images = images
+        self.page_id = page_id
+        self.url = url
+
+
+def md_to_document(md_file: str,
+                   add_info_panel: bool,
+                   text: Optional[str] = None,
+                   cache: Optional[RenderCache] = None) -> MarkdownDocument:
+    """Converts given md_file to html. If text is given (e.g. read from stdin) it's used
+       instead of file contents and md_file only names the source. Rendered html is
+       reused from cache if markdown hasn't changed since it was rendered"""
+
+    md = __get_file_contents(md_file) if text is None else text
+    if cache is None:
+        return __render(md_file, md, add_info_panel)
+
+    key = content_digest(tool_version(), __markdown2().__version__, json.dumps(MD_EXTRAS),
+                         str(add_info_panel), md_file, md)
+    entry = cache.get(key)
+    if entry:
+        logger.debug("Using cached HTML of `%s`", md_file)
+        entry["images"] = [tuple(image) for image in entry["images"]]
+        return MarkdownDocument(md_file, md, **entry)
+
+    document = __render(md_file, md, add_info_panel)
+    cache.put(key, {"html": document.html, "metadata": document.metadata,
+                    "images": document.images, "page_id": document.page_id,
+                    "url": document.url})
+    return document
+
+
+def __markdown2():
+    """Imports markdown2 on first conversion, so it isn't loaded just to parse arguments"""
+    # pylint: disable=import-outside-toplevel
+    import markdown2
+    return markdown2
+
+
+def __render(md_file: str, md: str, add_info_panel: bool) -> MarkdownDocument:
     logger.debug("Converting MD to HTML")
-    md = __get_file_contents(md_file)
     images = __get_images_from_file(md)
 
-    html = markdown2.markdown_path(
-        path=md_file,
-        extras=[
-            "metadata",
-            "strike",
-            "tables",
-            "wiki-tables",
-            "code-friendly",
-            "fenced-code-blocks",
-            "footnotes",
-        ],
-    )
-    page_id_from_meta, url = __parse_confluence_url(html.metadata)
+    html = __markdown2().markdown(md, extras=MD_EXTRAS)
+    metadata = dict(html.metadata or {})
+    page_id_from_meta, url = __parse_confluence_url(metadata)
     if add_info_panel:
         html = __get_info_panel(md_file) + html
 
     md_file_dir = os.path.dirname(md_file)
-    html = __rewrite_images(html, md_file_dir, images)
+    html = __rewrite_images(str(html), md_file_dir, images)
     html = __fix_code_blocks(html)
-    return html, page_id_from_meta, url, images
+    return MarkdownDocument(md_file, md, html, metadata, images, page_id_from_meta, url)
+
+
+def md_to_html(md_file: str,
+               add_info_panel: bool) -> Tuple[Any, Optional[str], Optional[str], List]:
+    """Converts given md_file to html"""
+    document = md_to_document(md_file, add_info_panel)
+    return document.html, document.page_id, document.url, document.images
 
 def __parse_confluence_url(meta: Dict[str, str]) -> Tuple[Optional[str], Optional[str]]:
     """Parses Confluence page URL and returns page_id and host"""
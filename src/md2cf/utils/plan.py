@@ -0,0 +1,130 @@
+"""
+Dry run: reports what publishing would change without writing anything
+"""
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from .log import logger
+from .sync import index_children, publish_file
+from .confluencemd import PAGE_EXPAND
+
+PAGES_PER_SEARCH = 50
+
+
+class Plan:
+    """Pages to create, update or skip and attachments to upload, collected by
+       ConfluenceMD instead of writing when it's given a plan"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.entries: List[dict] = []
+
+    def add(self, md_file: str, action: str, page_id: Optional[str] = None,
+            title: Optional[str] = None, reason: str = "", uploads: Optional[List[str]] = None,
+            size: int = 0) -> None:
+        """Records what would be done with given file"""
+        # pylint: disable=too-many-arguments
+        with self.lock:
+            self.entries.append({"file": md_file, "action": action, "page_id": page_id,
+                                 "title": title, "reason": reason,
+                                 "uploads": uploads or [], "bytes": size})
+
+    def summary(self) -> Dict[str, int]:
+        """Returns number of pages per action, attachments to upload and estimated bytes"""
+        summary = {"create": 0, "update": 0, "skip": 0, "error": 0}
+        for entry in self.entries:
+            summary[entry["action"]] += 1
+        summary["uploads"] = sum(len(entry["uploads"]) for entry in self.entries)
+        summary["bytes"] = sum(entry["bytes"] for entry in self.entries)
+        return summary
+
+    def to_json(self) -> str:
+        """Returns plan with summary as JSON"""
+        return json.dumps({"pages": self.entries, "summary": self.summary()}, indent=1)
+
+    def log(self) -> None:
+        """Logs one line per file and the summary"""
+        for entry in self.entries:
+            details = entry["reason"]
+            if entry["uploads"]:
+                details += f", upload {', '.join(entry['uploads'])}"
+            logger.info("  %-7s %s -> %s %s (%s)", entry["action"].upper(), entry["file"],
+                        entry["page_id"] or "new page", entry["title"] or "",
+                        details.strip(", "))
+        summary = self.summary()
+        logger.info("%i page(s) to create, %i to update, %i to skip, %i failed, "
+                    "%i attachment(s) to upload, ~%i bytes", summary["create"],
+                    summary["update"], summary["skip"], summary["error"],
+                    summary["uploads"], summary["bytes"])
+
+
+def prefetch_pages(confluence, page_ids: List[str]) -> None:
+    """Reads given pages with their attachments in batched CQL searches,
+       so planning doesn't need a few requests per page"""
+    page_ids = [page_id for page_id in dict.fromkeys(page_ids)
+                if page_id not in confluence.remote_pages]
+    for chunk_start in range(0, len(page_ids), PAGES_PER_SEARCH):
+        chunk = page_ids[chunk_start:chunk_start + PAGES_PER_SEARCH]
+        try:
+            response = confluence.get("rest/api/content/search",
+                                      params={"cql": f"id in ({','.join(chunk)})",
+                                              "expand": PAGE_EXPAND,
+                                              "limit": PAGES_PER_SEARCH})
+        # pylint: disable=broad-exception-caught
+        except (RuntimeError, AssertionError, Exception) as error:
+            logger.debug("Unable to prefetch pages (%s), reading them one by one", error)
+            return
+        for page in (response or {}).get("results", []):
+            confluence.remote_pages[page["id"]] = page
+
+
+def plan_files(confluence,
+               files: List[str],
+               parent_id: Optional[str] = None,
+               overwrite: bool = False,
+               max_workers: int = 4) -> Plan:
+    """Converts all files, prefetches pages they point to and plans publishing of each"""
+    plan = confluence.plan = confluence.plan or Plan()
+    documents = {}
+    for md_file in files:
+        conf_md = confluence.for_file(md_file)
+        try:
+            documents[md_file] = conf_md.convert()
+        # pylint: disable=broad-exception-caught
+        except (RuntimeError, AssertionError, Exception) as error:
+            plan.add(md_file, "error", reason=str(error))
+
+    page_ids = []
+    for (md_file, document) in documents.items():
+        entry = confluence.for_file(md_file).manifest_entry()
+        page_ids.extend(page_id for page_id in [document.page_id, entry and entry["page_id"]]
+                        if page_id)
+    if confluence.conf_url:
+        prefetch_pages(confluence, page_ids)
+    index_children(confluence, parent_id, list(documents))
+
+    def publish(md_file: str) -> None:
+        try:
+            publish_file(confluence.for_file(md_file), parent_id, overwrite, documents[md_file])
+        # pylint: disable=broad-exception-caught
+        except (RuntimeError, AssertionError, Exception) as error:
+            plan.add(md_file, "error", reason=str(error))
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        list(executor.map(publish, documents))
+    order = {md_file: index for (index, md_file) in enumerate(files)}
+    plan.entries.sort(key=lambda entry: order.get(entry["file"], len(order)))
+    return plan
+
+
+def write_plan(plan: Plan, path: str) -> None:
+    """Writes plan as JSON to given file, `-` writes to stdout"""
+    if path == "-":
+        print(plan.to_json())
+        return
+    with open(path, "w", encoding="utf-8") as stream:
+        stream.write(plan.to_json())
+    logger.info("Plan written to `%s`", os.path.abspath(path))
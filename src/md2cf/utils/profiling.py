@@ -0,0 +1,47 @@
+"""
+Profiling of conversion and publishing with cProfile
+"""
+import sys
+import cProfile
+import pstats
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List
+
+from . import stats
+from .log import logger
+
+
+@contextmanager
+def profile(path: str) -> Iterator[pstats.Stats]:
+    """Profiles the block, including threads it starts, and writes cProfile stats to `path`
+       (open with `python -m pstats`, snakeviz or gprof2dot). Stages and HTTP requests of
+       ConfluenceMD are written to `path` + `.trace.json` as a timeline (Chrome trace format,
+       open with Perfetto or chrome://tracing). Yields pstats.Stats filled in on exit"""
+    profilers: List[cProfile.Profile] = [cProfile.Profile()]
+    lock = threading.Lock()
+
+    def profile_thread(*_) -> None:
+        """Starts profiler in every new thread, cProfile before 3.12 follows one thread only"""
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        with lock:
+            profilers.append(profiler)
+        profiler.enable()
+
+    result = pstats.Stats()
+    stats.TRACE = stats.Trace()
+    if sys.version_info < (3, 12):
+        threading.setprofile(profile_thread)
+    profilers[0].enable()
+    try:
+        yield result
+    finally:
+        profilers[0].disable()
+        threading.setprofile(None)
+        trace, stats.TRACE = stats.TRACE, None
+        with lock:
+            result.add(*profilers)
+        result.dump_stats(path)
+        trace.write(path + ".trace.json")
+        logger.info("Profile written to `%s`, stage timeline to `%s.trace.json`", path, path)
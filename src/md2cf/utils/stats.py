@@ -0,0 +1,181 @@
+"""
+Run instrumentation: time spent per stage, HTTP requests by endpoint and counters
+"""
+import os
+import re
+import json
+import time
+import functools
+import threading
+from contextlib import contextmanager
+from urllib import parse
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from .log import logger
+
+ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+ISSUE_SEGMENT = re.compile(r"(?<=/issue/)[^/]+")
+
+
+class Trace:
+    """Timeline of stages and HTTP requests of all threads in Chrome trace event format,
+       opened by chrome://tracing, Perfetto or speedscope"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.events: List[dict] = []
+
+    def add(self, name: str, category: str, start: float, end: float) -> None:
+        """Records event of given category that run from start to end (perf_counter)"""
+        with self.lock:
+            self.events.append({"name": name, "cat": category, "ph": "X",
+                                "ts": round((start - self.started) * 1e6),
+                                "dur": round((end - start) * 1e6),
+                                "pid": os.getpid(), "tid": threading.get_ident()})
+
+    def write(self, path: str) -> None:
+        """Writes recorded events as JSON"""
+        with open(path, "w", encoding="utf-8") as stream:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, stream)
+
+
+# Trace recorded by all Stats while profiling, see `profiling.profile`
+TRACE: Optional[Trace] = None
+
+
+def endpoint(method: str, url: str) -> str:
+    """Returns request method and URL path with ids replaced, e.g.
+       `GET /wiki/rest/api/content/{id}/child/attachment`"""
+    path = ID_SEGMENT.sub("/{id}", parse.urlsplit(url).path)
+    return f"{method.upper()} {ISSUE_SEGMENT.sub('{key}', path)}"
+
+
+def body_size(body: Any) -> int:
+    """Returns size of request body, 0 if it's streamed"""
+    if isinstance(body, str):
+        return len(body.encode("utf-8"))
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    return 0
+
+
+def timed(stage: str) -> Callable:
+    """Decorates ConfluenceMD method, so its wall time is recorded as given stage"""
+    def decorator(method: Callable) -> Callable:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.stats.stage(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Stats:
+    """Wall time per stage, requests, bytes and throttled responses per endpoint
+       and named counters of one run, shared by all threads"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.endpoints: Dict[str, Dict[str, int]] = {}
+        self.counters: Dict[str, int] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Records wall time of the block as given stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.add_stage(name, end - start)
+            if TRACE:
+                TRACE.add(name, "stage", start, end)
+
+    def add_stage(self, name: str, seconds: float) -> None:
+        """Records one call of given stage that took given time"""
+        with self.lock:
+            stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0})
+            stage["calls"] += 1
+            stage["seconds"] += seconds
+
+    def add_request(self, method: str, url: str, status: int, sent: int, received: int,
+                    start: Optional[float] = None) -> None:
+        """Records one HTTP request (every retry counts) sent at `start` (perf_counter)"""
+        # pylint: disable=too-many-arguments
+        # transport imports Stats, so its status codes are imported when requests are recorded
+        # pylint: disable=import-outside-toplevel
+        from .transport import THROTTLED_STATUS_CODES
+        name = endpoint(method, url)
+        with self.lock:
+            stats = self.endpoints.setdefault(name, {
+                "requests": 0, "throttled": 0, "errors": 0, "bytes_sent": 0, "bytes_received": 0})
+            stats["requests"] += 1
+            stats["throttled"] += status in THROTTLED_STATUS_CODES
+            stats["errors"] += status >= 400 and status not in THROTTLED_STATUS_CODES
+            stats["bytes_sent"] += sent
+            stats["bytes_received"] += received
+        if TRACE and start is not None:
+            TRACE.add(name, "http", start, time.perf_counter())
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Increases named counter"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self, **extra: Any) -> dict:
+        """Returns all recorded stats with totals, extra sections are added as given"""
+        with self.lock:
+            endpoints = {name: dict(stats) for (name, stats) in sorted(self.endpoints.items())}
+            report = {
+                "elapsed": round(time.perf_counter() - self.started, 3),
+                "stages": {name: {"calls": stage["calls"], "seconds": round(stage["seconds"], 3)}
+                           for (name, stage) in self.stages.items()},
+                "requests": {
+                    "total": sum(stats["requests"] for stats in endpoints.values()),
+                    "bytes_sent": sum(stats["bytes_sent"] for stats in endpoints.values()),
+                    "bytes_received": sum(stats["bytes_received"]
+                                          for stats in endpoints.values()),
+                    "endpoints": endpoints},
+                "counters": dict(sorted(self.counters.items()))}
+        report.update(extra)
+        return report
+
+    @staticmethod
+    def log(report: dict) -> None:
+        """Logs report as summary tables"""
+        logger.info("%-52s %8s %10s", "Stage", "Calls", "Seconds")
+        for (name, stage) in sorted(report["stages"].items(),
+                                    key=lambda item: -item[1]["seconds"]):
+            logger.info("%-52s %8i %10.3f", name, stage["calls"], stage["seconds"])
+        logger.info("%-52s %8s %10s %10s %10s", "Endpoint", "Requests", "Throttled",
+                    "Sent KB", "Recv KB")
+        for (name, stats) in report["requests"]["endpoints"].items():
+            logger.info("%-52s %8i %10i %10.1f %10.1f", name[:52], stats["requests"],
+                        stats["throttled"], stats["bytes_sent"] / 1024,
+                        stats["bytes_received"] / 1024)
+        logger.info("%-52s %8i %10s %10.1f %10.1f", "Total", report["requests"]["total"], "",
+                    report["requests"]["bytes_sent"] / 1024,
+                    report["requests"]["bytes_received"] / 1024)
+        if "http" in report:
+            logger.info("HTTP: %i connection(s), %i throttled, %i retried",
+                        report["http"]["connections"], report["http"]["throttled"],
+                        report["http"]["retried"])
+        for (name, cache) in report.get("caches", {}).items():
+            logger.info("%s cache: %i hit(s), %i miss(es)", name, cache["hits"], cache["misses"])
+        if report["counters"]:
+            logger.info(", ".join(f"{name.replace('_', ' ')}: {value}"
+                                  for (name, value) in report["counters"].items()))
+        logger.info("Finished in %.3fs", report["elapsed"])
+
+    @staticmethod
+    def write(report: dict, path: Optional[str]) -> None:
+        """Writes report as JSON to given file, `-` writes to stdout"""
+        if path == "-":
+            print(json.dumps(report, indent=1))
+            return
+        with open(path, "w", encoding="utf-8") as stream:
+            json.dump(report, stream, indent=1)
+        logger.info("Stats written to `%s`", path)
@@ -0,0 +1,197 @@
+"""
+Publishes many markdown files in one go
+"""
+import os
+import glob
+import time
+import functools
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .log import logger
+from .cache import RenderCache
+from .md2html import MarkdownDocument, md_to_document
+
+# Spawning a pool of processes takes longer than converting a few files in the publishing
+# threads, without --convert_workers the pool is used for more files only
+CONVERT_POOL_THRESHOLD = 50
+
+def find_markdown_files(path: str) -> List[str]:
+    """Returns sorted list of markdown files in given directory or matching given glob"""
+    if os.path.isdir(path):
+        pattern = os.path.join(path, "**", "*.md")
+    else:
+        pattern = path
+    files = sorted(file for file in glob.glob(pattern, recursive=True) if os.path.isfile(file))
+    assert files, f"No markdown files found in `{path}`"
+    return files
+
+
+def sync_files(confluence,
+               files: List[str],
+               parent_id: Optional[str] = None,
+               overwrite: bool = False,
+               max_workers: int = 4,
+               convert_workers: int = 0) -> List[Tuple[str, Optional[str], Optional[Exception]]]:
+    """Updates (or creates under parent_id) a page for every given file, reusing
+       one ConfluenceMD session. Returns (md_file, page_id, error) per file.
+       With a pool (see convert_pool_size) markdown is converted in processes and every
+       converted document is handed over to the publishing threads as soon as it's ready"""
+    def publish(md_file: str, document: Optional[MarkdownDocument]) -> str:
+        return publish_file(confluence.for_file(md_file), parent_id, overwrite, document)
+
+    results = {}
+    index_children(confluence, parent_id, files)
+    seed_links(confluence, files, parent_id)
+    with confluence.manifest_batch(), \
+            ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        pool_size = convert_pool_size(convert_workers, len(files))
+        if pool_size:
+            futures = {}
+            render_cache_path = confluence.render_cache.path if confluence.render_cache else None
+            with ProcessPoolExecutor(max_workers=pool_size,
+                                     mp_context=multiprocessing.get_context("spawn")) as converters:
+                conversions = {converters.submit(convert_file, md_file,
+                                                 confluence.add_info_panel,
+                                                 render_cache_path): md_file
+                               for md_file in files}
+                for conversion in as_completed(conversions):
+                    md_file = conversions[conversion]
+                    try:
+                        (document, seconds, cache_hit) = conversion.result()
+                        confluence.stats.add_stage("convert", seconds)
+                        if confluence.render_cache and cache_hit is not None:
+                            confluence.render_cache.count(cache_hit)
+                        futures[executor.submit(publish, md_file, document)] = md_file
+                    # pylint: disable=broad-exception-caught
+                    except (RuntimeError, AssertionError, Exception) as error:
+                        logger.debug("Converting `%s` failed: %s", md_file, error)
+                        results[md_file] = (md_file, None, error)
+        else:
+            futures = {executor.submit(publish, md_file, None): md_file for md_file in files}
+
+        for future in as_completed(futures):
+            md_file = futures[future]
+            try:
+                results[md_file] = (md_file, future.result(), None)
+            # pylint: disable=broad-exception-caught
+            except (RuntimeError, AssertionError, Exception) as error:
+                logger.debug("Publishing `%s` failed: %s", md_file, error)
+                results[md_file] = (md_file, None, error)
+
+        for (md_file, error) in update_links(confluence, files, executor).items():
+            results[md_file] = (md_file, None, error)
+
+    return [results[md_file] for md_file in files]
+
+
+def update_links(confluence, files: List[str], executor: Executor) -> Dict[str, Exception]:
+    """Second phase of publishing many files: updates pages of files linking to files
+       whose pages were created in the first phase. Returns errors by file"""
+    if confluence.plan is not None:
+        return {}
+    paths = {os.path.abspath(md_file): md_file for md_file in files}
+    pending = [paths[path] for path in confluence.link_index.pending() if path in paths]
+    if not pending:
+        return {}
+
+    logger.info("Updating links in %i page(s)", len(pending))
+    futures = {executor.submit(lambda md_file: confluence.for_file(md_file).update_existing(
+        confluence.link_index.get(md_file)), md_file): md_file for md_file in pending}
+    errors = {}
+    for future in as_completed(futures):
+        try:
+            future.result()
+        # pylint: disable=broad-exception-caught
+        except (RuntimeError, AssertionError, Exception) as error:
+            logger.debug("Updating links of `%s` failed: %s", futures[future], error)
+            errors[futures[future]] = error
+    return errors
+
+
+def index_children(confluence, parent_id: Optional[str], files: Iterable[str] = ()) -> None:
+    """Reads pages under parent_id and looks up titles of given files once, so titles
+       of all files are resolved without a lookup per file"""
+    if not parent_id or not confluence.conf_url:
+        return
+    try:
+        confluence.index_children(parent_id, [page_title(md_file) for md_file in files])
+    # pylint: disable=broad-exception-caught
+    except (RuntimeError, AssertionError, Exception) as error:
+        logger.debug("Unable to index pages under `%s`: %s", parent_id, error)
+
+
+def seed_links(confluence, files: List[str], parent_id: Optional[str]) -> None:
+    """Records pages of files known from front matter, or found under parent_id by title,
+       so links to them are resolved on the first pass"""
+    confluence.link_index.seed(files)
+    index = confluence.page_index.get(parent_id) if parent_id else None
+    if not index:
+        return
+    for md_file in files:
+        page = index["titles"].get(page_title(md_file))
+        if page and not confluence.link_index.get(md_file):
+            confluence.link_index.add(md_file, page["id"])
+
+
+def publish_file(conf_md,
+                 parent_id: Optional[str] = None,
+                 overwrite: bool = False,
+                 document: Optional[MarkdownDocument] = None,
+                 title: Optional[str] = None) -> str:
+    """Updates page the file points to in its metadata, or creates one under parent_id
+       titled after the file name (unless title is given)"""
+    document = document or conf_md.convert()
+    if document.page_id or not parent_id:
+        return conf_md.update_existing(document=document)
+    title = title or page_title(conf_md.md_file)
+    return conf_md.create_new(parent_id, title, overwrite, document=document)
+
+
+def page_title(md_file: str) -> str:
+    """Returns title of page created for the file, its name without extension"""
+    return os.path.splitext(os.path.basename(md_file))[0]
+
+
+def convert_pool_size(convert_workers: int, file_count: int) -> int:
+    """Returns number of processes converting given number of files, 0 converts them in
+       the publishing threads. With convert_workers 0 a pool of all CPUs is used above
+       CONVERT_POOL_THRESHOLD files, 1 never uses a pool"""
+    if not convert_workers:
+        convert_workers = (os.cpu_count() or 1) if file_count > CONVERT_POOL_THRESHOLD else 1
+    workers = min(convert_workers, file_count)
+    return workers if workers > 1 else 0
+
+
+def convert_file(md_file: str,
+                 add_info_panel: bool,
+                 render_cache_path: Optional[str] = None
+                 ) -> Tuple[MarkdownDocument, float, Optional[bool]]:
+    """Converts markdown file to html, runs in a worker process. Returns the document,
+       seconds the conversion took and whether it was a render cache hit (None without cache)"""
+    cache = __get_render_cache(render_cache_path) if render_cache_path else None
+    hits = cache.hits if cache else 0
+    start = time.perf_counter()
+    document = md_to_document(md_file, add_info_panel, cache=cache)
+    seconds = time.perf_counter() - start
+    return document, seconds, (cache.hits > hits if cache else None)
+
+
+@functools.lru_cache(maxsize=None)
+def __get_render_cache(path: str) -> RenderCache:
+    """One render cache per worker process"""
+    return RenderCache(path)
+
+
+def log_summary(results: List[Tuple[str, Optional[str], Optional[Exception]]]) -> int:
+    """Logs per file summary, returns number of failures"""
+    failed = 0
+    for (md_file, page_id, error) in results:
+        if error is None:
+            logger.info("  OK      %s -> %s", md_file, page_id)
+        else:
+            failed += 1
+            logger.error("  FAILED  %s: %s", md_file, error)
+    logger.info("%i file(s) published, %i failed", len(results) - failed, failed)
+    return failed
@@ -0,0 +1,175 @@
+"""
+HTTP transport shared by Confluence, Jira and license check
+"""
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Callable, Mapping, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .log import logger
+from .stats import Stats, body_size
+
+THROTTLED_STATUS_CODES = (429, 503)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+
+class RequestScheduler:
+    """Sends requests at most `max_rps` per second and retries throttled ones.
+       429 responses are retried for every method (the request was not processed),
+       503 responses only for idempotent methods. `Retry-After` is honored and pauses
+       all requests, otherwise jittered exponential backoff is used"""
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self,
+                 max_rps: float = 0,
+                 max_retries: int = 5,
+                 backoff: float = 0.5,
+                 max_backoff: float = 60) -> None:
+        self.max_rps = max_rps
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+        self.paused_until = 0.0
+        self.requests = 0
+        self.throttled = 0
+        self.retried = 0
+
+    def send(self, method: str, send: Callable[[], requests.Response]) -> requests.Response:
+        """Sends request with given send function, retrying if throttled"""
+        attempt = 0
+        while True:
+            self.wait_for_slot()
+            response = send()
+            delay = self.get_retry_delay(method, response.status_code, response.headers, attempt)
+            if delay is None:
+                return response
+            logger.debug("HTTP: %s throttled with %i, retrying in %.1fs",
+                         response.url, response.status_code, delay)
+            response.close()
+            attempt += 1
+
+    def get_retry_delay(self, method: str, status: int, headers: Mapping[str, str],
+                        attempt: int) -> Optional[float]:
+        """Returns how long to wait before retrying a request that got given response,
+           or None if it shouldn't be retried"""
+        if status not in THROTTLED_STATUS_CODES:
+            return None
+
+        with self.lock:
+            self.throttled += 1
+        retryable = status == 429 or method.upper() in IDEMPOTENT_METHODS
+        if not retryable or attempt >= self.max_retries:
+            return None
+
+        delay = self.__get_retry_after(headers)
+        if delay is None:
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1)
+        with self.lock:
+            self.retried += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        return delay
+
+    def wait_for_slot(self) -> None:
+        """Blocks until next request can be sent"""
+        delay = self.reserve_slot()
+        if delay:
+            time.sleep(delay)
+
+    def reserve_slot(self) -> float:
+        """Reserves next request slot, returns how long to wait for it"""
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot, self.paused_until)
+            if self.max_rps:
+                self.next_slot = slot + 1 / self.max_rps
+            self.requests += 1
+        return slot - now
+
+    def __get_retry_after(self, headers: Mapping[str, str]) -> Optional[float]:
+        """Returns delay from `Retry-After` header given in seconds or as HTTP date"""
+        retry_after = headers.get("Retry-After")
+        if not retry_after:
+            return None
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(self.max_backoff, max(0.0, delay))
+
+
+class SchedulingAdapter(HTTPAdapter):
+    """HTTPAdapter sending every request through the scheduler"""
+
+    def __init__(self, scheduler: RequestScheduler, *args,
+                 stats: Optional[Stats] = None, **kwargs) -> None:
+        self.scheduler = scheduler
+        self.stats = stats
+        super().__init__(*args, **kwargs)
+
+    # pylint: disable=arguments-differ
+    def send(self, request, **kwargs):
+        def send_once() -> requests.Response:
+            start = time.perf_counter()
+            response = super(SchedulingAdapter, self).send(request, **kwargs)
+            if self.stats:
+                self.stats.add_request(request.method, request.url, response.status_code,
+                                       body_size(request.body),
+                                       int(response.headers.get("Content-Length") or 0), start)
+            return response
+
+        return self.scheduler.send(request.method, send_once)
+
+    def connections(self) -> int:
+        """Returns number of connections opened by all pools"""
+        pools = self.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys() if key in pools)
+
+
+class Transport:
+    """One requests session with a tuned connection pool, so Confluence and Jira
+       clients reuse keep-alive connections instead of doing own TLS handshakes.
+       All requests go through one RequestScheduler and are recorded in `run_stats`"""
+    # pylint: disable=too-few-public-methods,too-many-arguments
+
+    def __init__(self,
+                 pool_size: int = 20,
+                 keep_alive: bool = True,
+                 timeout: int = 75,
+                 proxy: Optional[str] = None,
+                 verify_ssl: bool = True,
+                 scheduler: Optional[RequestScheduler] = None) -> None:
+        self.timeout = timeout
+        self.scheduler = scheduler or RequestScheduler()
+        self.run_stats = Stats()
+        self.adapter = SchedulingAdapter(self.scheduler, pool_connections=4, pool_maxsize=pool_size,
+                                         stats=self.run_stats)
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.session.verify = verify_ssl
+        if not keep_alive:
+            self.session.headers["Connection"] = "close"
+        if proxy:
+            self.session.proxies = {"http": proxy, "https": proxy}
+
+    def stats(self) -> dict:
+        """Returns number of requests sent, connections opened and throttled/retried requests"""
+        return {"requests": self.scheduler.requests,
+                "connections": self.adapter.connections(),
+                "throttled": self.scheduler.throttled,
+                "retried": self.scheduler.retried}
+
+    def log_stats(self) -> None:
+        """Logs connection reuse and throttling"""
+        stats = self.stats()
+        logger.debug("HTTP: %i request(s) over %i connection(s), %i throttled, %i retried",
+                     stats["requests"], stats["connections"], stats["throttled"], stats["retried"])
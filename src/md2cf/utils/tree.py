@@ -0,0 +1,160 @@
+"""
+Publishes a directory tree as a tree of pages
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from .log import logger
+from .sync import publish_file, update_links
+
+INDEX_FILES = ("index.md", "readme.md")
+CHILDREN_MACRO = '<ac:structured-macro ac:name="children" ac:schema-version="2" />'
+
+
+class TreeNode:
+    """Markdown file or directory mapped to a page. Directories are published from
+       their index file, or as a page listing its children if there's none"""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, path: str, title: str, md_file: Optional[str],
+                 parent: Optional["TreeNode"]) -> None:
+        self.path = path
+        self.title = title
+        self.md_file = md_file
+        self.parent = parent
+        self.page_id = None
+        self.planned = False
+
+
+def build_tree(root: str) -> List[List[TreeNode]]:
+    """Returns nodes of markdown files and directories under root, level by level.
+       Hidden directories and directories without markdown files are left out"""
+    assert os.path.isdir(root), f"`{root}` is not a directory"
+    levels: List[List[TreeNode]] = []
+
+    def walk(directory: str, parent: Optional[TreeNode], depth: int) -> bool:
+        entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+        index = __find_index(entries) if parent else None
+        nodes = [TreeNode(entry.path, os.path.splitext(entry.name)[0], entry.path, parent)
+                 for entry in entries
+                 if entry.is_file() and entry.name.endswith(".md") and entry.path != index]
+        for entry in entries:
+            if entry.is_dir() and not entry.name.startswith("."):
+                node = TreeNode(entry.path, entry.name,
+                                __find_index(list(os.scandir(entry.path))), parent)
+                if walk(entry.path, node, depth + 1) or node.md_file:
+                    nodes.append(node)
+        if nodes:
+            while len(levels) <= depth:
+                levels.append([])
+            levels[depth].extend(nodes)
+        return bool(nodes)
+
+    walk(root, None, 0)
+    assert levels, f"No markdown files found in `{root}`"
+    return levels
+
+
+def __find_index(entries: list) -> Optional[str]:
+    """Returns index file among directory entries"""
+    for name in INDEX_FILES:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower() == name:
+                return entry.path
+    return None
+
+
+def publish_tree(confluence,
+                 root: str,
+                 parent_id: str,
+                 overwrite: bool = False,
+                 max_workers: int = 4) -> List[Tuple[str, Optional[str], Optional[Exception]]]:
+    """Publishes directory tree under parent_id level by level, pages of one level
+       in parallel. Existing pages are found with one search of the whole subtree.
+       Returns (path, page_id, error) per file or directory"""
+    assert parent_id, "Provide parent_id to publish the tree under"
+    levels = build_tree(root)
+    index_descendants(confluence, parent_id, [node.title for level in levels for node in level])
+
+    def publish(node: TreeNode) -> Tuple[str, Optional[str], Optional[Exception]]:
+        try:
+            if node.parent and node.parent.planned:
+                node.planned = True
+                confluence.plan.add(node.path, "create", None, node.title,
+                                    f"new page under new `{node.parent.title}`")
+                return (node.path, None, None)
+            if node.parent and not node.parent.page_id:
+                raise RuntimeError(f"Parent page `{node.parent.title}` was not published")
+
+            page_parent_id = node.parent.page_id if node.parent else parent_id
+            if node.md_file:
+                conf_md = confluence.for_file(node.md_file)
+                node.page_id = publish_file(conf_md, page_parent_id, overwrite, title=node.title)
+            else:
+                node.page_id = __publish_directory(confluence, node, page_parent_id)
+            node.planned = confluence.plan is not None and node.page_id is None
+            return (node.path, node.page_id, None)
+        # pylint: disable=broad-exception-caught
+        except (RuntimeError, AssertionError, Exception) as error:
+            logger.debug("Publishing `%s` failed: %s", node.path, error)
+            return (node.path, None, error)
+
+    nodes = [node for level in levels for node in level]
+    files = [node.md_file for node in nodes if node.md_file]
+    seed_links(confluence, nodes, parent_id)
+    results = []
+    with confluence.manifest_batch(), \
+            ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for (depth, level) in enumerate(levels):
+            logger.debug("Publishing %i page(s) on level %i", len(level), depth + 1)
+            results.extend(executor.map(publish, level))
+        errors = update_links(confluence, files, executor)
+
+    return [(path, None, errors[node.md_file]) if node.md_file in errors else (path, page_id, error)
+            for ((path, page_id, error), node) in zip(results, nodes)]
+
+
+def __publish_directory(confluence, node: TreeNode, parent_id: str) -> Optional[str]:
+    """Returns page of directory without index file, creates one listing its children
+       if it doesn't exist"""
+    (space, page) = confluence.lookup_page(parent_id, node.title)
+    if page:
+        return page["id"]
+    if confluence.plan is not None:
+        confluence.plan.add(node.path, "create", None, node.title,
+                            f"new page in `{space}` listing its children")
+        return None
+
+    logger.debug("Creating page `%s` for directory `%s`", node.title, node.path)
+    response = confluence.create_page(space, node.title, body=CHILDREN_MACRO,
+                                      parent_id=parent_id, type="page",
+                                      representation="storage", editor="v2")
+    confluence.page_index.setdefault(parent_id, {"space": space, "titles": {}})
+    confluence.index_new_page(parent_id, space, node.title, response)
+    return response["id"]
+
+
+def index_descendants(confluence, parent_id: str, titles: List[str]) -> None:
+    """Reads the whole subtree under parent_id, so pages are found without a lookup
+       per node. If that fails every node is looked up on its own"""
+    try:
+        confluence.index_descendants(parent_id, titles)
+    # pylint: disable=broad-exception-caught
+    except (RuntimeError, AssertionError, Exception) as error:
+        logger.debug("Unable to index pages below `%s`: %s", parent_id, error)
+
+
+def seed_links(confluence, nodes: List[TreeNode], parent_id: str) -> None:
+    """Records pages of files known from front matter, or found in the indexed subtree
+       at their place in the tree, so links to them are resolved on the first pass"""
+    confluence.link_index.seed([node.md_file for node in nodes if node.md_file])
+    pages = {}
+    for node in nodes:
+        page_parent_id = pages.get(node.parent.path) if node.parent else parent_id
+        index = confluence.page_index.get(page_parent_id) if page_parent_id else None
+        page = index["titles"].get(node.title) if index else None
+        if page:
+            pages[node.path] = page["id"]
+            if node.md_file and not confluence.link_index.get(node.md_file):
+                confluence.link_index.add(node.md_file, page["id"])
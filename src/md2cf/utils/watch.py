@@ -0,0 +1,177 @@
+"""
+Watches markdown files and images they reference, republishes changed ones
+"""
+import os
+import time
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from .log import logger
+from .sync import find_markdown_files, publish_file
+
+
+class Watcher:
+    """Keeps one ConfluenceMD session warm and republishes files as they change.
+       Changes are detected with `watchdog` (inotify and friends) when it's installed,
+       otherwise by polling every `interval` seconds. Publishing waits until files
+       stop changing for `debounce` seconds, so editors saving in steps trigger one update"""
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+
+    def __init__(self,
+                 confluence,
+                 path: str,
+                 parent_id: Optional[str] = None,
+                 overwrite: bool = False,
+                 interval: float = 1.0,
+                 debounce: float = 0.5,
+                 use_watchdog: bool = True) -> None:
+        self.confluence = confluence
+        self.path = path
+        self.parent_id = parent_id
+        self.overwrite = overwrite
+        self.interval = interval
+        self.debounce = debounce
+        self.use_watchdog = use_watchdog
+        self.stop_event = threading.Event()
+        self.wake = threading.Event()
+        self.signatures: Dict[str, Optional[Tuple[int, int]]] = {}
+        self.dependencies: Dict[str, List[str]] = {}
+        self.observer = None
+        self.handler = None
+        self.watched_dirs: Set[str] = set()
+        self.published = 0
+
+    def run(self) -> None:
+        """Publishes all files, then republishes changed ones until `stop` is called"""
+        self.__start_observer()
+        try:
+            self.__publish(self.__find_files())
+            logger.info("Watching %i file(s) for changes, press Ctrl+C to stop",
+                        len(self.dependencies))
+            while not self.stop_event.is_set():
+                self.wake.wait(self.interval)
+                self.wake.clear()
+                changed = self.__changed_files()
+                if changed:
+                    self.__publish(changed)
+        finally:
+            if self.observer:
+                self.observer.stop()
+                self.observer.join()
+
+    def stop(self) -> None:
+        """Stops watching"""
+        self.stop_event.set()
+        self.wake.set()
+
+    def __find_files(self) -> List[str]:
+        if os.path.isfile(self.path):
+            return [self.path]
+        return find_markdown_files(self.path)
+
+    def __changed_files(self) -> List[str]:
+        """Returns markdown files whose source or images changed, once changes settle"""
+        changed = self.__changed_paths()
+        if not changed:
+            return []
+        while not self.stop_event.is_set():
+            time.sleep(self.debounce)
+            settling = self.__changed_paths()
+            if not settling:
+                break
+            changed |= settling
+
+        return [md_file for (md_file, paths) in self.dependencies.items()
+                if changed.intersection(paths)] + \
+               sorted(path for path in changed if path not in self.dependencies
+                      and path.endswith(".md"))
+
+    def __changed_paths(self) -> Set[str]:
+        """Returns watched paths (and new markdown files) modified since last check"""
+        paths = set(self.signatures)
+        if not os.path.isfile(self.path):
+            try:
+                paths.update(self.__find_files())
+            except AssertionError:
+                pass
+        changed = set()
+        for path in paths:
+            signature = Watcher.__signature(path)
+            if signature != self.signatures.get(path):
+                self.signatures[path] = signature
+                changed.add(path)
+        return changed
+
+    def __publish(self, files: List[str]) -> None:
+        with self.confluence.manifest_batch():
+            for md_file in files:
+                if not os.path.isfile(md_file):
+                    logger.info("`%s` removed, not watched anymore", md_file)
+                    self.dependencies.pop(md_file, None)
+                    continue
+
+                conf_md = self.confluence.for_file(md_file)
+                try:
+                    document = conf_md.convert()
+                    images = [conf_md.get_image_path(path) for (_alt, path) in document.images
+                              if os.path.isfile(os.path.join(conf_md.md_file_dir, path))
+                              or os.path.isfile(path)]
+                    self.__watch([md_file] + images, md_file)
+                    page_id = publish_file(conf_md, self.parent_id, self.overwrite, document)
+                    logger.info("Published `%s` -> %s", md_file, page_id)
+                    self.published += 1
+                # pylint: disable=broad-exception-caught
+                except (RuntimeError, AssertionError, Exception) as error:
+                    logger.error("Unable to publish `%s`: %s", md_file, error)
+                    self.__watch(self.dependencies.get(md_file, [md_file]), md_file)
+
+                if conf_md.add_meta:
+                    # metadata written to the file must not trigger another update
+                    self.signatures[md_file] = Watcher.__signature(md_file)
+
+    def __watch(self, paths: List[str], md_file: str) -> None:
+        """Registers paths given markdown file depends on"""
+        self.dependencies[md_file] = paths
+        for path in paths:
+            if path not in self.signatures:
+                self.signatures[path] = Watcher.__signature(path)
+            self.__watch_dir(os.path.dirname(os.path.abspath(path)))
+
+    def __start_observer(self) -> None:
+        """Starts watchdog observer if available, polling is used otherwise"""
+        if not self.use_watchdog:
+            return
+        try:
+            # pylint: disable=import-outside-toplevel
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            logger.debug("watchdog not installed, polling every %.1fs", self.interval)
+            return
+
+        wake = self.wake
+
+        class Handler(FileSystemEventHandler):
+            """Wakes the watcher up on any file system event"""
+            def on_any_event(self, event):
+                wake.set()
+
+        self.handler = Handler()
+        self.observer = Observer()
+        self.observer.start()
+        if not os.path.isfile(self.path):
+            self.__watch_dir(self.path if os.path.isdir(self.path) else ".", recursive=True)
+
+    def __watch_dir(self, directory: str, recursive: bool = False) -> None:
+        if not self.observer or directory in self.watched_dirs:
+            return
+        self.watched_dirs.add(directory)
+        self.observer.schedule(self.handler, directory, recursive=recursive)
+
+    @staticmethod
+    def __signature(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
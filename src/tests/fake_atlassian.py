@@ -0,0 +1,297 @@
+"""
+Local stand-in for the Confluence and Jira REST endpoints used by ConfluenceMD,
+serves the offline test suite (run in CI without credentials) and the benchmarks
+"""
+import re
+import json
+import time
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+
+# pylint: disable=missing-function-docstring,invalid-name
+
+class FakeAtlassian:
+    """In-memory Confluence/Jira instance served over HTTP on localhost"""
+
+    def __init__(self, licensed: bool = True, latency: float = 0, rate_limit: int = 0) -> None:
+        self.lock = threading.Lock()
+        self.licensed = licensed
+        self.license_status = 200
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.recent_requests = []
+        self.fail_uploads = set()
+        self.unindexed = set()
+        self.throttled_responses = 0
+        self.throttle_status = 429
+        self.retry_after = None
+        self.pages = {}
+        self.attachments = {}
+        self.labels = {}
+        self.issues = {}
+        self.requests = []
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.next_id = 1000
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.__handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def __enter__(self) -> "FakeAtlassian":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_page(self, title: str, space: str = "SP", body: str = "",
+                 parent_id: str = None) -> str:
+        with self.lock:
+            self.next_id += 1
+            page_id = str(self.next_id)
+            self.pages[page_id] = {"id": page_id, "title": title, "space": space,
+                                   "body": body, "version": 1, "parent_id": parent_id}
+            self.attachments[page_id] = []
+            self.labels[page_id] = []
+            return page_id
+
+    def add_issue(self, key: str, summary: str, status: str = "Open") -> None:
+        self.issues[key] = {"key": key, "fields": {
+            "summary": summary,
+            "status": {"name": status},
+            "issuetype": {"iconUrl": f"{self.url}icons/{key}.png"}}}
+
+    def throttle(self, responses: int, status: int = 429, retry_after: str = None) -> None:
+        """Responds to next requests with given throttling status"""
+        with self.lock:
+            self.throttled_responses = responses
+            self.throttle_status = status
+            self.retry_after = retry_after
+
+    def reset_stats(self) -> None:
+        """Forgets requests and transferred bytes counted so far"""
+        with self.lock:
+            self.requests.clear()
+            self.bytes_received = 0
+            self.bytes_sent = 0
+
+    def count(self, method: str, pattern: str) -> int:
+        """Returns number of requests with given method and path matching pattern"""
+        return len([path for (req_method, path) in self.requests
+                    if req_method == method and re.search(pattern, path)])
+
+    def over_rate_limit(self) -> bool:
+        """Whether more than `rate_limit` requests came in the last second, call with lock held.
+           Throttled requests respond with 429 and Retry-After of 1 second"""
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        self.recent_requests = [at for at in self.recent_requests if now - at < 1]
+        if len(self.recent_requests) >= self.rate_limit:
+            self.throttle_status = 429
+            self.retry_after = "1"
+            return True
+        self.recent_requests.append(now)
+        return False
+
+    def ancestors(self, page_id: str) -> list:
+        """Returns ids of page ancestors, root first"""
+        ancestors = []
+        parent_id = self.pages[page_id]["parent_id"]
+        while parent_id:
+            ancestors.insert(0, parent_id)
+            parent_id = self.pages[parent_id]["parent_id"]
+        return ancestors
+
+    def page_json(self, page_id: str) -> dict:
+        page = self.pages[page_id]
+        return {"id": page_id, "type": "page", "status": "current", "title": page["title"],
+                "space": {"key": page["space"]},
+                "version": {"number": page["version"]},
+                "body": {"storage": {"value": page["body"], "representation": "storage"}},
+                "ancestors": [{"id": ancestor_id} for ancestor_id in self.ancestors(page_id)],
+                "children": {"attachment": {"results": self.attachments[page_id],
+                                            "size": len(self.attachments[page_id]),
+                                            "limit": 25}},
+                "_links": {"base": self.url + "wiki", "webui": f"/spaces/{page['space']}/pages/{page_id}"}}
+
+    def __handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *_):
+                pass
+
+            def do_GET(self):
+                self.__dispatch("GET")
+
+            def do_POST(self):
+                self.__dispatch("POST")
+
+            def do_PUT(self):
+                self.__dispatch("PUT")
+
+            def __dispatch(self, method):
+                url = parse.urlsplit(self.path)
+                query = dict(parse.parse_qsl(url.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                with fake.lock:
+                    fake.requests.append((method, url.path))
+                    fake.bytes_received += len(body)
+                    throttle = fake.throttled_responses > 0
+                    fake.throttled_responses -= 1 if throttle else 0
+                    throttle = fake.over_rate_limit() or throttle
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if throttle:
+                    status, payload = fake.throttle_status, {"message": "Rate limit exceeded"}
+                else:
+                    status, payload = fake.route(method, url.path, query, body,
+                                                 self.headers.get("Content-Type", ""))
+                data = json.dumps(payload).encode("utf-8")
+                with fake.lock:
+                    fake.bytes_sent += len(data)
+                self.send_response(status)
+                if throttle and fake.retry_after is not None:
+                    self.send_header("Retry-After", str(fake.retry_after))
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    # pylint: disable=too-many-return-statements,too-many-branches,too-many-arguments
+    def route(self, method: str, path: str, query: dict, body: bytes, content_type: str):
+        if path.endswith("/addons/secure-markdown-for-confluence"):
+            if self.license_status != 200:
+                return self.license_status, {"message": "License unavailable"}
+            return 200, {"license": {"active": self.licensed}}
+
+        if path == "/rest/api/2/search":
+            keys = re.search(r"key in \((?P<keys>[^)]*)\)", query["jql"]).group("keys").split(",")
+            issues = [self.issues[key] for key in keys if key in self.issues]
+            start = int(query.get("startAt", 0))
+            limit = int(query.get("maxResults", 50))
+            return 200, {"issues": issues[start:start + limit], "startAt": start,
+                         "maxResults": limit, "total": len(issues)}
+
+        match = re.fullmatch(r"/rest/api/2/issue/(?P<key>[^/]+)", path)
+        if match:
+            issue = self.issues.get(match.group("key"))
+            return (200, issue) if issue else (404, {"errorMessages": ["Issue does not exist"]})
+
+        if path == "/wiki/rest/api/content/search":
+            results = [self.page_json(page_id) for page_id in self.pages
+                       if page_id not in self.unindexed
+                       and self.__cql_match(query["cql"], page_id)]
+            start = int(query.get("start", 0))
+            limit = int(query.get("limit", 25))
+            return 200, {"results": results[start:start + limit], "start": start,
+                         "limit": limit, "size": len(results[start:start + limit])}
+
+        match = re.fullmatch(r"/wiki/rest/api/content/(?P<id>\d+)/child/attachment(/(?P<att>\d+)/data)?",
+                             path)
+        if match:
+            page_id = match.group("id")
+            if page_id not in self.pages:
+                return 404, {"message": "No content with the given id"}
+            if method == "GET":
+                results = [att for att in self.attachments[page_id]
+                           if "filename" not in query or att["title"] == query["filename"]]
+                return 200, {"results": results, "size": len(results)}
+            return self.__upload(page_id, match.group("att"), body, content_type)
+
+        match = re.fullmatch(r"/wiki/rest/api/content/(?P<id>\d+)/label", path)
+        if match:
+            label = json.loads(body)["name"]
+            self.labels[match.group("id")].append(label)
+            return 200, {"results": [{"name": label}]}
+
+        match = re.fullmatch(r"/wiki/rest/api/content/(?P<id>\d+)/history", path)
+        if match:
+            return 200, {"lastUpdated": {"number": self.pages[match.group("id")]["version"]}}
+
+        match = re.fullmatch(r"/wiki/rest/api/content/(?P<id>\d+)", path)
+        if match:
+            page_id = match.group("id")
+            if page_id not in self.pages:
+                return 404, {"message": "No content with the given id"}
+            if method == "PUT":
+                data = json.loads(body)
+                page = self.pages[page_id]
+                if data["version"]["number"] != page["version"] + 1:
+                    return 409, {"message": "Version conflict"}
+                page.update(title=data["title"], version=data["version"]["number"],
+                            body=data["body"]["storage"]["value"])
+            return 200, self.page_json(page_id)
+
+        if re.fullmatch(r"/wiki/rest/api/content/?", path):
+            if method == "POST":
+                data = json.loads(body)
+                parent_id = data["ancestors"][0]["id"] if data.get("ancestors") else None
+                page_id = self.add_page(data["title"], data["space"]["key"],
+                                        data["body"]["storage"]["value"], parent_id)
+                return 200, self.page_json(page_id)
+            results = [self.page_json(page_id) for (page_id, page) in self.pages.items()
+                       if page["title"] == query.get("title")
+                       and page["space"] == query.get("spaceKey")]
+            return 200, {"results": results, "size": len(results)}
+
+        return 404, {"message": f"Unknown endpoint {method} {path}"}
+
+    def __cql_match(self, cql: str, page_id: str) -> bool:
+        """Supports `id in (...)`, `id = X`, `parent = X`, `ancestor = X`, `title in (...)`
+           and `title = "T"` joined with `or`, title optionally restricted with `space = "S"`"""
+        page = self.pages[page_id]
+        ids = re.search(r"id in \((?P<ids>[^)]*)\)", cql)
+        if ids and page_id in ids.group("ids").split(","):
+            return True
+        if re.search(rf"\bid = {page_id}\b", cql) or \
+                re.search(rf"\bparent = {page['parent_id']}\b", cql):
+            return True
+        ancestor = re.search(r"\bancestor = (?P<id>\d+)", cql)
+        if ancestor and ancestor.group("id") in self.ancestors(page_id):
+            return True
+        titles = re.search(r'title in \((?P<titles>[^)]*)\)', cql)
+        if titles and page["title"] in [re.sub(r"\\(.)", r"\1", title) for title in
+                                        re.findall(r'"((?:[^"\\]|\\.)*)"',
+                                                   titles.group("titles"))]:
+            return True
+        title = re.search(r'title = "(?P<title>(?:[^"\\]|\\.)*)"', cql)
+        space = re.search(r'space = "(?P<space>[^"]*)"', cql)
+        return bool(title) and re.sub(r"\\(.)", r"\1", title.group("title")) == page["title"] \
+            and (not space or space.group("space") == page["space"])
+
+    def __upload(self, page_id: str, attachment_id: str, body: bytes, content_type: str):
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body)
+        fields = {part.get_param("name", header="content-disposition"): part
+                  for part in message.iter_parts()}
+        upload = fields["file"]
+        if upload.get_filename() in self.fail_uploads:
+            return 500, {"message": f"Unable to store {upload.get_filename()}"}
+        comment = fields["comment"].get_content() if "comment" in fields else ""
+        with self.lock:
+            attachments = self.attachments[page_id]
+            if attachment_id:
+                attachment = [att for att in attachments if att["id"] == attachment_id][0]
+            else:
+                self.next_id += 1
+                attachment = {"id": str(self.next_id), "type": "attachment",
+                              "title": upload.get_filename()}
+                attachments.append(attachment)
+            attachment.update(extensions={"fileSize": len(upload.get_payload(decode=True))},
+                              metadata={"comment": comment})
+            return 200, {"results": [attachment], "size": 1}
@@ -0,0 +1,98 @@
+"""
+Offline tests for the async publishing engine, run against a local fake instance
+"""
+import time
+import asyncio
+
+import pytest
+
+from src.md2cf.utils.aio import AsyncConfluenceMD, RequestError, publish_files
+from src.md2cf.utils.confluencemd import ConfluenceMD
+from src.tests.fake_atlassian import FakeAtlassian
+from src.tests.test_publish import write_md
+
+pytest.importorskip("aiohttp")
+
+# pylint: disable=missing-function-docstring,missing-class-docstring,redefined-outer-name
+
+@pytest.fixture
+def fake(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    with FakeAtlassian() as fake_atlassian:
+        yield fake_atlassian
+
+
+class TestAsync:
+
+    def test_publish_many(self, fake, tmp_path):
+        (tmp_path / "image.png").write_bytes(b"image")
+        parent_id = fake.add_page("Parent")
+        files = []
+        for i in range(10):
+            page_id = fake.add_page(f"Async {i}")
+            files.append(write_md(tmp_path, f"async{i}.md",
+                                  f"---\nconfluence-url: {fake.url}wiki/spaces/SP/pages/"
+                                  f"{page_id}/Async\n---\n# Async {i}\n\n![image](image.png)\n"))
+        files.append(write_md(tmp_path, "new.md", "# New page\n"))
+
+        fake.latency = 0.1
+        conf_md = ConfluenceMD(username="user", token="token", url=fake.url, add_label="async")
+        start = time.perf_counter()
+        results = publish_files(conf_md, files, parent_id)
+        elapsed = time.perf_counter() - start
+
+        assert [error for (_file, _id, error) in results] == [None] * 11
+        for (md_file, page_id, _error) in results[:10]:
+            page = fake.pages[page_id]
+            assert f"<h1>Async {md_file[-4]}</h1>" in page["body"] and page["version"] == 2
+            assert fake.labels[page_id] == ["async"]
+            assert [att["title"] for att in fake.attachments[page_id]] == ["image.png"]
+        assert fake.pages[results[10][1]]["parent_id"] == parent_id
+        # 11 pages take a few round trips instead of ~50 sequential ones
+        assert elapsed < 20 * fake.latency
+
+        fake.latency = 0
+        results = publish_files(conf_md, files[:10], parent_id)
+        assert fake.count("PUT", r"/content/\d+$") == 10
+
+    def test_throttled_requests_are_retried(self, fake, tmp_path):
+        page_id = fake.add_page("Throttled")
+        md_file = write_md(tmp_path, "throttled.md", "# Throttled\n")
+        conf_md = ConfluenceMD(username="user", md_file=md_file, token="token", url=fake.url)
+        fake.throttle(2, retry_after="0")
+
+        async def publish():
+            async with AsyncConfluenceMD(conf_md) as engine:
+                return await engine.update_existing(md_file, page_id)
+
+        assert asyncio.run(publish()) == page_id
+        assert fake.pages[page_id]["version"] == 2
+        assert conf_md.transport.scheduler.retried == 2
+
+    def test_error_response_has_status(self, fake, tmp_path):
+        md_file = write_md(tmp_path, "missing.md", "# Missing\n")
+        conf_md = ConfluenceMD(username="user", md_file=md_file, token="token", url=fake.url)
+
+        async def publish():
+            async with AsyncConfluenceMD(conf_md) as engine:
+                return await engine.update_existing(md_file, "999999")
+
+        with pytest.raises(RequestError) as error:
+            asyncio.run(publish())
+        assert error.value.status == 404
+
+    def test_version_conflict_is_retried(self, fake, tmp_path):
+        parent_id = fake.add_page("Parent")
+        page_id = fake.add_page("conflict", parent_id=parent_id)
+        md_file = write_md(tmp_path, "conflict.md", "# Conflict\n")
+        conf_md = ConfluenceMD(username="user", token="token", url=fake.url)
+        conf_md.index_children(parent_id)
+        fake.pages[page_id]["version"] = 2
+
+        async def publish():
+            async with AsyncConfluenceMD(conf_md) as engine:
+                return await engine.create_new(md_file, parent_id, "conflict", overwrite=True)
+
+        assert asyncio.run(publish()) == page_id
+        assert fake.pages[page_id]["version"] == 3
+        assert fake.count("PUT", r"/content/\d+$") == 2
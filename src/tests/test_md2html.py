@@ -0,0 +1,71 @@
+"""
+Offline tests for markdown conversion
+"""
+import os
+import sys
+import json
+import subprocess
+
+from src.md2cf.utils.cache import RenderCache
+from src.md2cf.utils.export import export_files
+from src.md2cf.utils.md2html import md_to_document, md_to_html
+
+# pylint: disable=missing-function-docstring,missing-class-docstring
+
+class TestMd2Html:
+
+    def test_render_cache(self, tmp_path):
+        cache = RenderCache(str(tmp_path / "render"))
+        md_file = "src/tests/test_metadata.md"
+
+        first = md_to_document(md_file, True, cache=cache)
+        second = md_to_document(md_file, True, cache=cache)
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert second.html == first.html == md_to_html(md_file, True)[0]
+        assert second.page_id == first.page_id == "1117683721"
+
+        md_to_document(md_file, False, cache=cache)
+        md_to_document(md_file, True, text="# Changed\n", cache=cache)
+        assert (cache.hits, cache.misses) == (1, 3)
+
+    def test_render_cache_eviction(self, tmp_path):
+        cache = RenderCache(str(tmp_path / "render"), max_bytes=4096)
+        for i in range(50):
+            md_to_document("generated.md", False, text=f"# Page {i}\n", cache=cache)
+        entries = os.listdir(tmp_path / "render")
+        assert 0 < len(entries) < 50
+        assert sum(os.path.getsize(tmp_path / "render" / entry) for entry in entries) <= 4096
+
+    def test_export(self, tmp_path):
+        (tmp_path / "docs" / "guide").mkdir(parents=True)
+        (tmp_path / "docs" / "image.png").write_bytes(b"image")
+        (tmp_path / "docs" / "index.md").write_text("# Index\n\n![image](image.png)\n")
+        (tmp_path / "docs" / "guide" / "setup.md").write_text("# Setup\n")
+        (tmp_path / "docs" / "broken.md").write_text("![missing](missing.png)\n")
+        files = sorted(str(path) for path in (tmp_path / "docs").rglob("*.md"))
+        out = tmp_path / "out"
+
+        entries = export_files(files, str(out), render_cache=False)
+        assert [entry["error"] is None for entry in entries] == [False, True, True]
+        assert '<ri:attachment ri:filename="image.png" />' in \
+            (out / "index.html").read_text(encoding="utf-8")
+        assert (out / "guide" / "setup.html").read_text(encoding="utf-8") == entries[1]["html"]
+        manifest = json.loads((out / "export.json").read_text(encoding="utf-8"))
+        assert [image["name"] for image in manifest[2]["images"]] == ["image.png"]
+        assert manifest[2]["images"][0]["size"] == 5
+
+    def test_export_to_stdout(self, tmp_path):
+        (tmp_path / "one.md").write_text("# One\n")
+        (tmp_path / "two.md").write_text("# Two\n")
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+        def export(*args: str) -> str:
+            return subprocess.run([sys.executable, "-m", "src.md2cf.main", "-q", "export",
+                                   "--no_render_cache", *args], cwd=root, capture_output=True,
+                                  text=True, check=True).stdout
+
+        lines = [json.loads(line) for line in export("--dir", str(tmp_path)).splitlines()]
+        assert [(os.path.basename(line["file"]), line["html"]) for line in lines] == [
+            ("one.md", md_to_html(str(tmp_path / "one.md"), False)[0]),
+            ("two.md", md_to_html(str(tmp_path / "two.md"), False)[0])]
+        assert export("--file", str(tmp_path / "one.md")).strip() == lines[0]["html"].strip()
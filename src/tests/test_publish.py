@@ -0,0 +1,586 @@
+"""
+Offline tests for Confluence.md publishing, run against a local fake instance
+"""
+import os
+import json
+import time
+import pstats
+import threading
+
+import pytest
+from atlassian.errors import ApiError
+
+from src.md2cf.utils.cache import DigestStore, JsonStore
+from src.md2cf.utils import confluencemd
+from src.md2cf.utils.confluencemd import ATTACHMENTS_PAGE_SIZE, ConfluenceMD, \
+    attachment_digest, collect_attachments, replace_issue_links
+from src.md2cf.utils.sync import CONVERT_POOL_THRESHOLD, convert_pool_size, \
+    find_markdown_files, sync_files
+from src.md2cf.utils.watch import Watcher
+from src.md2cf.utils.plan import Plan, plan_files
+from src.md2cf.utils.tree import publish_tree
+from src.md2cf.utils.profiling import profile
+from src.tests.fake_atlassian import FakeAtlassian
+
+# pylint: disable=missing-function-docstring,missing-class-docstring,redefined-outer-name
+
+@pytest.fixture
+def fake(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    with FakeAtlassian() as fake_atlassian:
+        yield fake_atlassian
+
+
+def write_md(tmp_path, name: str, content: str) -> str:
+    md_file = tmp_path / name
+    md_file.write_text(content, encoding="utf-8")
+    return str(md_file)
+
+
+class TestPublish:
+
+    @staticmethod
+    def init_confluencemd(fake: FakeAtlassian, md_file: str, **kwargs) -> ConfluenceMD:
+        return ConfluenceMD(username="user", md_file=md_file, token="token",
+                            url=fake.url, **kwargs)
+
+    def test_unchanged_page_is_not_updated(self, fake, tmp_path):
+        page_id = fake.add_page("Digest test")
+        md_file = write_md(tmp_path, "digest.md", "# Digest test\n")
+
+        self.init_confluencemd(fake, md_file).update_existing(page_id)
+        assert fake.pages[page_id]["version"] == 2
+
+        self.init_confluencemd(fake, md_file).update_existing(page_id)
+        assert fake.pages[page_id]["version"] == 2
+        assert fake.count("PUT", r"/content/\d+$") == 1
+
+        write_md(tmp_path, "digest.md", "# Digest test changed\n")
+        self.init_confluencemd(fake, md_file).update_existing(page_id)
+        assert fake.pages[page_id]["version"] == 3
+
+    def test_force_update(self, fake, tmp_path):
+        page_id = fake.add_page("Force test")
+        md_file = write_md(tmp_path, "force.md", "# Force test\n")
+
+        self.init_confluencemd(fake, md_file).update_existing(page_id)
+        self.init_confluencemd(fake, md_file, force_update=True).update_existing(page_id)
+        assert fake.count("PUT", r"/content/\d+$") == 2
+
+    def test_unchanged_images_are_not_uploaded(self, fake, tmp_path):
+        page_id = fake.add_page("Images test")
+        (tmp_path / "one.png").write_bytes(b"one" * 100)
+        (tmp_path / "two.png").write_bytes(b"two" * 100)
+        md_file = write_md(tmp_path, "images.md", "![one](one.png)\n\n![two](two.png)\n")
+
+        self.init_confluencemd(fake, md_file).update_existing(page_id)
+        assert fake.count("POST", r"/child/attachment") == 2
+
+        write_md(tmp_path, "images.md", "Changed\n\n![one](one.png)\n\n![two](two.png)\n")
+        self.init_confluencemd(fake, md_file).update_existing(page_id)
+        assert fake.count("POST", r"/child/attachment") == 2
+
+        (tmp_path / "two.png").write_bytes(b"TWO" * 100)
+        self.init_confluencemd(fake, md_file).update_existing(page_id)
+        assert fake.count("POST", r"/child/attachment") == 3
+        assert fake.count("POST", r"/child/attachment/\d+/data") == 1
+        assert len(fake.attachments[page_id]) == 2
+
+    def test_parallel_uploads(self, fake, tmp_path):
+        markdown = ""
+        for i in range(8):
+            (tmp_path / f"image{i}.png").write_bytes(b"x" * i)
+            markdown += f"![image {i}](image{i}.png)\n\n"
+        md_file = write_md(tmp_path, "parallel.md", markdown)
+
+        fake.latency = 0.1
+        elapsed = {}
+        for parallel_uploads in [1, 8]:
+            page_id = fake.add_page(f"Parallel images test {parallel_uploads}")
+            conf_md = self.init_confluencemd(fake, md_file, max_parallel_uploads=parallel_uploads)
+            start = time.perf_counter()
+            conf_md.update_existing(page_id)
+            elapsed[parallel_uploads] = time.perf_counter() - start
+            assert len(fake.attachments[page_id]) == 8
+
+        # 8 uploads take one round trip instead of 8
+        assert elapsed[8] < elapsed[1] - 5 * fake.latency
+
+    def test_upload_errors_are_reported_per_file(self, fake, tmp_path, caplog):
+        page_id = fake.add_page("Upload errors test")
+        (tmp_path / "ok.png").write_bytes(b"ok")
+        (tmp_path / "broken.png").write_bytes(b"broken")
+        md_file = write_md(tmp_path, "errors.md", "![ok](ok.png)\n\n![broken](broken.png)\n")
+        fake.fail_uploads = {"broken.png"}
+
+        with pytest.raises(RuntimeError, match=r"Failed to upload 1 of 2 image\(s\).*broken.png"):
+            self.init_confluencemd(fake, md_file).update_existing(page_id)
+        assert [att["title"] for att in fake.attachments[page_id]] == ["ok.png"]
+        assert "Unable to upload image file" in caplog.text
+        assert fake.pages[page_id]["version"] == 1
+
+    def test_jira_issues_are_resolved_in_one_search(self, fake, tmp_path):
+        page_id = fake.add_page("Jira test")
+        fake.add_issue("AD-1", "First issue")
+        fake.add_issue("AD-2", "Second issue", "Done")
+        md_file = write_md(tmp_path, "jira.md", "[AD-1] [AD-2]\n\n[AD-1] [NOPE-1]\n\n[AD-1]\n")
+
+        self.init_confluencemd(fake, md_file, convert_jira=True).update_existing(page_id)
+        body = fake.pages[page_id]["body"]
+        assert body.count("AD-1: First issue [Open]</a>") == 3
+        assert "AD-2: Second issue [Done]</a>" in body
+        assert "[NOPE-1]" in body
+        assert fake.count("GET", r"/rest/api/2/search") == 1
+        assert fake.count("GET", r"/rest/api/2/issue/") == 0
+
+    def test_jira_issues_are_cached(self, fake, tmp_path):
+        fake.add_issue("AD-1", "First issue")
+        md_file = write_md(tmp_path, "jira.md", "[AD-1]\n")
+
+        for page in ["Jira cache 1", "Jira cache 2"]:
+            conf_md = self.init_confluencemd(fake, md_file, convert_jira=True)
+            conf_md.update_existing(fake.add_page(page))
+        assert fake.count("GET", r"/rest/api/2/search") == 1
+        assert conf_md.jira_cache.hits == 1
+
+        conf_md = self.init_confluencemd(fake, md_file, convert_jira=True, refresh_jira_cache=True)
+        conf_md.update_existing(fake.add_page("Jira cache 3"))
+        assert fake.count("GET", r"/rest/api/2/search") == 2
+
+    def test_adjacent_jira_issues(self, fake, tmp_path):
+        page_id = fake.add_page("Adjacent Jira test")
+        fake.add_issue("AD-1", "Follows [AD-2]")
+        fake.add_issue("AD-2", "Second issue", "Done")
+        md_file = write_md(tmp_path, "adjacent.md", "[AD-1][AD-1][AD-2]\n")
+
+        self.init_confluencemd(fake, md_file, convert_jira=True).update_existing(page_id)
+        body = fake.pages[page_id]["body"]
+        link = f'<a href="{fake.url}browse/AD-1"><ac:image><ri:url ri:value="{fake.url}icons/' \
+               'AD-1.png" /></ac:image> AD-1: Follows [AD-2] [Open]</a>'
+        assert body.startswith(f"<p>{link}{link}")
+        assert body.count("AD-2: Second issue [Done]</a>") == 1
+
+    def test_replace_issue_links(self):
+        url = "https://dirtyagile.atlassian.net/browse/AD-12"
+        html = (f'<p>[AD-1][AD-1] {url} {url}0</p><a href="{url}">[AD-2]</a>'
+                f'<p>"[AD-1]</p>')
+        links = {"[AD-1]": "<a>AD-1</a>", url: "<a>AD-12</a>"}
+        assert replace_issue_links(html, links) == (
+            f'<p><a>AD-1</a><a>AD-1</a> <a>AD-12</a> {url}0</p><a href="{url}">[AD-2]</a>'
+            f'<p>"[AD-1]</p>')
+
+    def test_collect_attachments(self):
+        attachments = {}
+        full = {"results": [{"title": f"image{i}.png", "metadata": {"comment": f"sha256:{i}"}}
+                            for i in range(ATTACHMENTS_PAGE_SIZE)], "size": ATTACHMENTS_PAGE_SIZE}
+        assert collect_attachments(attachments, full, 0) == ATTACHMENTS_PAGE_SIZE
+        last = {"results": [{"title": "last.png", "metadata": {}}], "size": 1}
+        assert collect_attachments(attachments, last, ATTACHMENTS_PAGE_SIZE) is None
+        assert len(attachments) == ATTACHMENTS_PAGE_SIZE + 1
+        assert attachment_digest(attachments["image7.png"]) == "7"
+        assert attachment_digest(attachments["last.png"]) is None
+
+    def test_digest_store_eviction(self, tmp_path):
+        store = DigestStore(str(tmp_path / "digests.sqlite"))
+        for i in range(20):
+            store.set(f"page{i}", f"digest{i}")
+        assert store.get("page0") == "digest0"
+        assert store.get("missing") is None
+
+        store = DigestStore(str(tmp_path / "digests.sqlite"), max_entries=5)
+        assert [store.get(f"page{i}") for i in range(20)] == [None] * 15 + \
+            [f"digest{i}" for i in range(15, 20)]
+
+    def test_license_is_checked_lazily_and_cached(self, fake, tmp_path):
+        md_file = write_md(tmp_path, "nojira.md", "# No Jira links\n")
+        self.init_confluencemd(fake, md_file, convert_jira=True).update_existing(
+            fake.add_page("License test 1"))
+        assert fake.count("GET", r"/addons/secure-markdown-for-confluence") == 0
+
+        fake.add_issue("AD-1", "First issue")
+        md_file = write_md(tmp_path, "jira.md", "[AD-1]\n")
+        for page in ["License test 2", "License test 3"]:
+            self.init_confluencemd(fake, md_file, convert_jira=True).update_existing(
+                fake.add_page(page))
+        assert fake.count("GET", r"/addons/secure-markdown-for-confluence") == 1
+
+    def test_license_errors_are_not_cached(self, fake):
+        fake.license_status = 500
+        assert not self.init_confluencemd(fake, None).license
+        assert not self.init_confluencemd(fake, None).license
+        assert fake.count("GET", r"/addons/secure-markdown-for-confluence") == 2
+
+        fake.license_status = 200
+        assert self.init_confluencemd(fake, None).license
+        fake.license_status = 404
+        assert self.init_confluencemd(fake, None).license
+        assert fake.count("GET", r"/addons/secure-markdown-for-confluence") == 3
+
+    def test_missing_app_is_cached(self, fake):
+        fake.license_status = 404
+        assert not self.init_confluencemd(fake, None).license
+        assert not self.init_confluencemd(fake, None).license
+        assert fake.count("GET", r"/addons/secure-markdown-for-confluence") == 1
+
+    def test_positional_arguments(self, fake):
+        conf_md = ConfluenceMD("user", None, "token", "", fake.url)
+        assert (conf_md.auth, conf_md.conf_url, conf_md.md_text) == \
+            (("user", "token"), f"{fake.url}wiki/", None)
+
+    def test_update_from_text(self, fake, tmp_path):
+        page_id = fake.add_page("Text test")
+        conf_md = ConfluenceMD(username="user", md_file="<stdin>", md_text="# From stdin\n",
+                               token="token", url=fake.url, add_meta=True)
+        conf_md.update_existing(page_id)
+        assert "<h1>From stdin</h1>" in fake.pages[page_id]["body"]
+        assert not (tmp_path / "<stdin>").exists()
+
+    @pytest.mark.parametrize("convert_workers", [0, 2])
+    def test_sync(self, fake, tmp_path, convert_workers):
+        pages = {}
+        for i in range(4):
+            page_id = fake.add_page(f"Sync {i}")
+            pages[page_id] = write_md(tmp_path, f"sync{i}.md",
+                                      f"---\nconfluence-url: {fake.url}wiki/spaces/SP/pages/"
+                                      f"{page_id}/Sync\n---\n# Synced {i}\n")
+        write_md(tmp_path, "broken.md", "# No metadata\n")
+
+        confluence = self.init_confluencemd(fake, None)
+        results = sync_files(confluence, find_markdown_files(str(tmp_path)),
+                             max_workers=2, convert_workers=convert_workers)
+        assert [(os.path.basename(md_file), error is None) for (md_file, _id, error) in results] \
+            == [("broken.md", False)] + [(f"sync{i}.md", True) for i in range(4)]
+        for (page_id, md_file) in pages.items():
+            assert f"<h1>Synced {md_file[-4]}</h1>" in fake.pages[page_id]["body"]
+        assert fake.count("GET", r"/addons/") == 0
+        assert confluence.stats_report()["caches"]["render"] == {"hits": 0, "misses": 5}
+
+        confluence = self.init_confluencemd(fake, None)
+        sync_files(confluence, find_markdown_files(str(tmp_path)),
+                   max_workers=2, convert_workers=convert_workers)
+        assert confluence.stats_report()["caches"]["render"] == {"hits": 5, "misses": 0}
+
+    def test_convert_pool_size(self, monkeypatch):
+        monkeypatch.setattr(os, "cpu_count", lambda: 8)
+        assert convert_pool_size(0, 4) == 0
+        assert convert_pool_size(0, CONVERT_POOL_THRESHOLD + 1) == 8
+        assert convert_pool_size(1, 1000) == 0
+        assert convert_pool_size(4, 2) == 2
+        assert convert_pool_size(4, 1) == 0
+
+    def test_create_lookup(self, fake, tmp_path):
+        parent_id = fake.add_page("Lookup parent")
+        fake.add_page('Quoted "title"', space="OTHER")
+        md_file = write_md(tmp_path, "lookup.md", "# Lookup\n")
+
+        conf_md = self.init_confluencemd(fake, md_file)
+        page_id = conf_md.create_new(parent_id, 'Quoted "title"', overwrite=False)
+        assert fake.pages[page_id]["space"] == "SP"
+        assert fake.count("GET", r"/content/search") == 1
+        assert fake.count("GET", r"/content/\d+$") == 1
+
+        with pytest.raises(AssertionError, match="already exists"):
+            self.init_confluencemd(fake, md_file).create_new(parent_id, 'Quoted "title"',
+                                                             overwrite=False)
+
+    def test_lookup_parent_missing_from_search(self, fake, tmp_path):
+        parent_id = fake.add_page("Unindexed parent")
+        existing_id = fake.add_page("Lookup", parent_id=parent_id)
+        fake.unindexed.add(parent_id)
+
+        conf_md = self.init_confluencemd(fake, None)
+        (space, page) = conf_md.lookup_page(parent_id, "Lookup")
+        assert (space, page["id"]) == ("SP", existing_id)
+        conf_md.index_children(parent_id)
+        assert conf_md.page_index[parent_id]["space"] == "SP"
+        assert fake.count("GET", r"/content/\d+$") == 2
+
+        with pytest.raises(ApiError, match="There is no content with the given id"):
+            conf_md.lookup_page("999999", "Lookup")
+        with pytest.raises(AssertionError, match="Invalid page id"):
+            conf_md.lookup_page("1 or space = X", "Lookup")
+
+    def test_sync_resolves_titles_once(self, fake, tmp_path, monkeypatch):
+        monkeypatch.setattr(confluencemd, "TITLES_PER_SEARCH", 2)
+        parent_id = fake.add_page("Sync parent")
+        fake.add_page("child4")
+        for i in range(5):
+            write_md(tmp_path, f"child{i}.md", f"# Child {i}\n")
+        files = find_markdown_files(str(tmp_path))
+        results = sync_files(self.init_confluencemd(fake, None), files, parent_id)
+        assert [error is None for (_file, _id, error) in results] == [True] * 4 + [False]
+        assert "already exists" in str(results[4][2])
+        assert fake.count("GET", r"/content/search") == 1 + 3
+        del fake.pages[[page_id for (page_id, page) in fake.pages.items()
+                        if page["title"] == "child4" and page["parent_id"] is None][0]]
+        sync_files(self.init_confluencemd(fake, None), files[4:], parent_id)
+
+        fake.requests.clear()
+        for i in range(5):
+            write_md(tmp_path, f"child{i}.md", f"# Child {i} changed\n")
+        results = sync_files(self.init_confluencemd(fake, None), files, parent_id, overwrite=True)
+        assert [error for (_file, _id, error) in results] == [None] * 5
+        assert fake.count("GET", r"/content/search") == 1
+        assert len([page for page in fake.pages.values() if page["parent_id"] == parent_id]) == 5
+
+    def test_links_between_files(self, fake, tmp_path):
+        parent_id = fake.add_page("Links parent")
+        existing_id = fake.add_page("Existing")
+        write_md(tmp_path, "existing.md",
+                 f"---\nconfluence-url: {fake.url}wiki/spaces/SP/pages/{existing_id}/Existing\n"
+                 "---\n# Existing\n")
+        write_md(tmp_path, "a.md", "# A\n\n[B](b.md#usage), [existing](existing.md)\n")
+        write_md(tmp_path, "b.md", "# B\n\n[missing](missing.md)\n")
+        files = find_markdown_files(str(tmp_path))
+        results = sync_files(self.init_confluencemd(fake, None), files, parent_id)
+        assert [error for (_file, _id, error) in results] == [None] * 3
+
+        pages = {page["title"]: page for page in fake.pages.values()}
+        assert f'href="{fake.url}wiki/pages/viewpage.action?pageId={pages["b"]["id"]}#usage"' \
+            in pages["a"]["body"]
+        assert f"pageId={existing_id}\"" in pages["a"]["body"]
+        assert 'href="missing.md"' in pages["b"]["body"]
+        # only the page linking to a new page may need a second update
+        assert fake.count("PUT", rf"/content/{pages['b']['id']}$") == 0
+        assert fake.count("PUT", rf"/content/{pages['a']['id']}$") <= 1
+
+        fake.requests.clear()
+        results = sync_files(self.init_confluencemd(fake, None), files, parent_id, overwrite=True)
+        assert [error for (_file, _id, error) in results] == [None] * 3
+        assert fake.count("PUT", r"/content/\d+$") == 0
+
+        write_md(tmp_path, "a.md", "# A changed\n\n[B](b.md#usage), [existing](existing.md)\n")
+        results = sync_files(self.init_confluencemd(fake, None), files, parent_id, overwrite=True)
+        assert fake.count("PUT", r"/content/\d+$") == 1
+        assert f"pageId={pages['b']['id']}#usage" in fake.pages[pages["a"]["id"]]["body"]
+
+        write_md(tmp_path, "c.md", "# C\n\n[existing](existing.md)\n")
+        page_id = self.init_confluencemd(fake, str(tmp_path / "c.md")).create_new(
+            parent_id, "c", overwrite=False)
+        assert f"pageId={existing_id}\"" in fake.pages[page_id]["body"]
+
+    def test_tree(self, fake, tmp_path):
+        parent_id = fake.add_page("Tree parent")
+        for (path, content) in [("intro.md", "# Intro\n"), ("guide/README.md", "# Guide\n"),
+                                ("guide/setup.md", "# Setup\n"),
+                                ("guide/deep/nested.md", "# Nested\n"),
+                                ("ops/runbook.md", "# Runbook\n"), (".git/skip.md", "# No\n")]:
+            (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+            write_md(tmp_path, path, content)
+        (tmp_path / "empty").mkdir()
+
+        results = publish_tree(self.init_confluencemd(fake, None), str(tmp_path), parent_id)
+        assert [error for (_path, _id, error) in results] == [None] * 7
+        assert fake.count("GET", r"/content/search") == 1
+        pages = {page["title"]: page for page in fake.pages.values()}
+        assert "<h1>Guide</h1>" in pages["guide"]["body"]
+        assert "ac:name=\"children\"" in pages["ops"]["body"]
+        assert [pages[title]["parent_id"] for title in ["intro", "guide", "ops"]] \
+            == [parent_id] * 3
+        assert pages["setup"]["parent_id"] == pages["deep"]["parent_id"] == pages["guide"]["id"]
+        assert pages["nested"]["parent_id"] == pages["deep"]["id"]
+        assert pages["runbook"]["parent_id"] == pages["ops"]["id"]
+        assert "skip" not in pages and "empty" not in pages
+
+        fake.requests.clear()
+        write_md(tmp_path, "guide/deep/nested.md", "# Nested changed\n")
+        results = publish_tree(self.init_confluencemd(fake, None), str(tmp_path), parent_id,
+                               overwrite=True)
+        assert [error for (_path, _id, error) in results] == [None] * 7
+        assert fake.count("GET", r"/content/search") == 1
+        assert fake.count("POST", r"/content/?$") == 0
+        assert fake.count("PUT", r"/content/\d+$") == 1
+
+    def test_tree_finds_titles_elsewhere_in_space(self, fake, tmp_path, monkeypatch):
+        monkeypatch.setattr(confluencemd, "TITLES_PER_SEARCH", 1)
+        parent_id = fake.add_page("Tree parent")
+        ops_id = fake.add_page("ops")
+        fake.add_page("runbook", space="OTHER")
+        (tmp_path / "ops").mkdir()
+        write_md(tmp_path, "ops/runbook.md", "# Runbook\n")
+
+        results = publish_tree(self.init_confluencemd(fake, None), str(tmp_path), parent_id)
+        assert [error for (_path, _id, error) in results] == [None] * 2
+        assert results[0][1] == ops_id
+        runbook = [page for page in fake.pages.values() if page["space"] == "SP"
+                   and page["title"] == "runbook"]
+        assert [page["parent_id"] for page in runbook] == [ops_id]
+        assert fake.count("GET", r"/content/search") == 3
+
+    def test_tree_without_index(self, fake, tmp_path):
+        parent_id = fake.add_page("Tree parent")
+        write_md(tmp_path, "intro.md", "# Intro\n")
+        (tmp_path / "ops").mkdir()
+        write_md(tmp_path, "ops/runbook.md", "# Runbook\n")
+
+        fake.throttle(1, status=500)
+        results = publish_tree(self.init_confluencemd(fake, None), str(tmp_path), parent_id)
+        assert [error for (_path, _id, error) in results] == [None] * 3
+        pages = {page["title"]: page for page in fake.pages.values()}
+        assert pages["runbook"]["parent_id"] == pages["ops"]["id"]
+
+    def test_connections_are_shared(self, fake, tmp_path):
+        fake.add_issue("AD-1", "First issue")
+        md_file = write_md(tmp_path, "jira.md", "[AD-1]\n")
+        conf_md = self.init_confluencemd(fake, md_file, convert_jira=True, jira_cache=False)
+        conf_md.update_existing(fake.add_page("Transport test"))
+
+        stats = conf_md.transport.stats()
+        assert stats["requests"] == len(fake.requests)
+        assert fake.count("GET", r"/rest/api/2/search") == 1
+        assert fake.count("GET", r"/addons/") == 1
+        assert stats["connections"] == 1
+
+    def test_stats(self, fake, tmp_path):
+        page_id = fake.add_page("Stats test")
+        fake.add_issue("AD-1", "First issue")
+        (tmp_path / "image.png").write_bytes(b"image" * 100)
+        md_file = write_md(tmp_path, "stats.md", "# Stats\n\n[AD-1]\n\n![image](image.png)\n")
+        conf_md = self.init_confluencemd(fake, md_file, convert_jira=True, add_label="docs")
+        conf_md.update_existing(page_id)
+        conf_md.update_existing(page_id)
+
+        report = conf_md.stats_report()
+        assert {"convert", "jira", "links", "attachments", "update_page", "label"} \
+            <= set(report["stages"])
+        assert report["stages"]["convert"]["calls"] == 2
+        endpoints = report["requests"]["endpoints"]
+        assert endpoints["POST /wiki/rest/api/content/{id}/child/attachment"]["requests"] == 1
+        assert endpoints["POST /wiki/rest/api/content/{id}/child/attachment"]["bytes_sent"] > 500
+        assert report["requests"]["total"] == len(fake.requests)
+        assert report["requests"]["bytes_sent"] == fake.bytes_received
+        assert report["counters"] == {"images_uploaded": 1, "images_unchanged": 0,
+                                      "pages_skipped": 1, "pages_updated": 1}
+        assert report["caches"]["render"] == {"hits": 1, "misses": 1}
+        assert report["http"]["retried"] == 0
+
+    def test_profile(self, fake, tmp_path):
+        parent_id = fake.add_page("Profile parent")
+        files = [write_md(tmp_path, f"profile{i}.md", f"# Profile {i}\n") for i in range(3)]
+        path = str(tmp_path / "run.prof")
+        with profile(path):
+            sync_files(self.init_confluencemd(fake, None), files, parent_id)
+
+        functions = {function for (_file, _line, function) in pstats.Stats(path).stats}
+        assert {"md_to_document", "create_page"} <= functions
+        with open(path + ".trace.json", encoding="utf-8") as stream:
+            events = json.load(stream)["traceEvents"]
+        assert len([event for event in events if event["name"] == "convert"]) == 3
+        assert len([event for event in events if event["cat"] == "http"]) == len(fake.requests)
+
+    def test_manifest(self, fake, tmp_path):
+        parent_id = fake.add_page("Manifest parent")
+        (tmp_path / "image.png").write_bytes(b"image")
+        md_file = write_md(tmp_path, "manifest.md", "# Manifest\n\n![image](image.png)\n")
+        manifest = str(tmp_path / "manifest.json")
+
+        conf_md = self.init_confluencemd(fake, md_file, manifest_file=manifest)
+        page_id = conf_md.create_new(parent_id, "Manifest", overwrite=False)
+        entry = conf_md.manifest.get(md_file)
+        assert (entry["page_id"], entry["space"], entry["version"]) == (page_id, "SP", 1)
+        assert list(entry["attachments"]) == ["image.png"]
+
+        fake.requests.clear()
+        write_md(tmp_path, "manifest.md", "# Manifest changed\n\n![image](image.png)\n")
+        conf_md = self.init_confluencemd(fake, md_file, manifest_file=manifest)
+        assert conf_md.create_new(parent_id, "Manifest", overwrite=False) == page_id
+        assert fake.requests == [("PUT", f"/wiki/rest/api/content/{page_id}")]
+        assert conf_md.manifest.get(md_file)["version"] == 2
+
+        fake.pages[page_id]["version"] = 5
+        write_md(tmp_path, "manifest.md", "# Edited meanwhile\n\n![image](image.png)\n")
+        self.init_confluencemd(fake, md_file, manifest_file=manifest).update_existing(page_id)
+        assert "Edited meanwhile" in fake.pages[page_id]["body"]
+        assert fake.pages[page_id]["version"] == 6
+        assert fake.count("POST", r"/child/attachment") == 0
+
+    def test_manifest_is_written_once_per_sync(self, fake, tmp_path, monkeypatch):
+        parent_id = fake.add_page("Manifest parent")
+        for i in range(5):
+            write_md(tmp_path, f"page{i}.md", f"# Page {i}\n")
+        manifest = str(tmp_path / "manifest.json")
+        writes = []
+        update = JsonStore.update
+        monkeypatch.setattr(JsonStore, "update", lambda store, values: (
+            writes.append(store.path), update(store, values)))
+
+        files = find_markdown_files(str(tmp_path))
+        sync_files(self.init_confluencemd(fake, None, manifest_file=manifest), files, parent_id)
+        assert writes.count(manifest) == 1
+        with open(manifest, encoding="utf-8") as stream:
+            assert sorted(json.load(stream)) == [f"page{i}.md" for i in range(5)]
+
+    def test_plan(self, fake, tmp_path):
+        parent_id = fake.add_page("Plan parent")
+        (tmp_path / "image.png").write_bytes(b"image")
+        pages = {}
+        for name in ["unchanged", "changed", "remote"]:
+            pages[name] = fake.add_page(f"Plan {name}")
+            write_md(tmp_path, f"{name}.md",
+                     f"---\nconfluence-url: {fake.url}wiki/spaces/SP/pages/{pages[name]}/P\n"
+                     f"---\n# {name}\n\n![image](image.png)\n")
+        write_md(tmp_path, "new.md", "# New\n\n![image](image.png)\n")
+        files = find_markdown_files(str(tmp_path))
+        sync_files(self.init_confluencemd(fake, None), [files[0], files[3]])
+        sync_files(self.init_confluencemd(fake, None, digest_file=str(tmp_path / "other.sqlite")),
+                   files[2:3])
+        write_md(tmp_path, "changed.md",
+                 f"---\nconfluence-url: {fake.url}wiki/spaces/SP/pages/{pages['changed']}/P\n"
+                 f"---\n# Changed\n\n![image](image.png)\n")
+
+        fake.requests.clear()
+        confluence = self.init_confluencemd(fake, None, plan=Plan())
+        plan = plan_files(confluence, files, parent_id)
+        assert [(os.path.basename(entry["file"]), entry["action"], entry["uploads"])
+                for entry in plan.entries] == [
+                    ("changed.md", "update", []), ("new.md", "create", ["image.png"]),
+                    ("remote.md", "update", []), ("unchanged.md", "skip", [])]
+        assert [entry["reason"] for entry in plan.entries if entry["action"] == "update"] == [
+            "content changed since last push", "not pushed from here before"]
+        assert plan.summary()["uploads"] == 1
+        # prefetch, pages under the parent and the new page title in the whole space
+        assert fake.count("GET", r"/content/search") == 3
+        assert fake.count("GET", r"/content/\d+") == 0
+        assert fake.count("PUT", ".") == fake.count("POST", ".") == 0
+
+    def test_watch(self, fake, tmp_path):
+        page_id = fake.add_page("Watch test")
+        (tmp_path / "image.png").write_bytes(b"image")
+        md_file = write_md(tmp_path, "watch.md",
+                           f"---\nconfluence-url: {fake.url}wiki/spaces/SP/pages/{page_id}/W\n"
+                           f"---\n# Watch\n\n![image](image.png)\n")
+        other_page_id = fake.add_page("Watch other")
+        write_md(tmp_path, "other.md",
+                 f"---\nconfluence-url: {fake.url}wiki/spaces/SP/pages/{other_page_id}/W\n"
+                 f"---\n# Other\n")
+
+        conf_md = self.init_confluencemd(fake, None, add_meta=True)
+        watcher = Watcher(conf_md, str(tmp_path), interval=0.05, debounce=0.1,
+                          use_watchdog=False)
+        thread = threading.Thread(target=watcher.run)
+        thread.start()
+
+        def wait_for(condition):
+            deadline = time.monotonic() + 10
+            while not condition() and time.monotonic() < deadline:
+                time.sleep(0.05)
+            assert condition()
+
+        try:
+            wait_for(lambda: watcher.published == 2)
+            assert fake.pages[page_id]["version"] == 2
+
+            (tmp_path / "image.png").write_bytes(b"new image")
+            wait_for(lambda: watcher.published == 3)
+            assert fake.count("POST", r"/child/attachment/\d+/data") == 1
+
+            with open(md_file, "a", encoding="utf-8") as stream:
+                stream.write("\nMore text\n")
+            wait_for(lambda: watcher.published == 4)
+            assert "More text" in fake.pages[page_id]["body"]
+            time.sleep(0.3)
+            assert watcher.published == 4
+            assert fake.pages[other_page_id]["version"] == 2
+        finally:
+            watcher.stop()
+            thread.join()
@@ -0,0 +1,49 @@
+"""
+Startup tests: parsing arguments and converting markdown must not load the HTTP stack
+"""
+import os
+import sys
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+HEAVY_MODULES = {"atlassian", "requests", "urllib3", "markdown2", "coloredlogs", "termcolor",
+                 "aiohttp"}
+IMPORT_BUDGET = 0.1  # seconds to import md2cf.main, was ~0.3 with eager imports
+
+# pylint: disable=missing-function-docstring,missing-class-docstring
+
+def import_times(*args: str) -> dict:
+    """Runs python with `-X importtime`, returns cumulative import seconds by module"""
+    process = subprocess.run([sys.executable, "-X", "importtime", *args], cwd=ROOT,
+                             capture_output=True, text=True, check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            (_self, cumulative, module) = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                times[module.strip()] = int(cumulative) / 1e6
+    return times
+
+
+class TestStartup:
+
+    def test_help_does_not_load_http_stack(self):
+        modules = import_times("-m", "src.md2cf.main", "--user", "user", "--help")
+        assert not HEAVY_MODULES & set(modules)
+
+    def test_conversion_does_not_load_http_stack(self):
+        modules = import_times("-c", "from src.md2cf.utils.md2html import md_to_document; "
+                               "md_to_document('src/tests/test_basic.md', False)")
+        assert "markdown2" in modules
+        assert not {"atlassian", "requests"} & set(modules)
+
+    def test_import_time_budget(self):
+        times = min((import_times("-c", "import src.md2cf.main") for _ in range(3)),
+                    key=lambda times: times["src.md2cf.main"])
+        assert times["src.md2cf.main"] < IMPORT_BUDGET
+
+    def test_export_does_not_load_http_stack(self):
+        modules = import_times("-m", "src.md2cf.main", "-q", "export",
+                               "--file", "src/tests/test_basic.md", "--no_render_cache")
+        assert "markdown2" in modules
+        assert not {"atlassian", "requests"} & set(modules)
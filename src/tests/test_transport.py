@@ -0,0 +1,109 @@
+"""
+Offline tests for shared HTTP transport and request scheduler
+"""
+import time
+
+import pytest
+from requests import HTTPError
+
+from src.md2cf.utils import confluencemd
+from src.md2cf.utils.confluencemd import ConfluenceMD
+from src.md2cf.utils.transport import RequestScheduler, Transport
+from src.tests.fake_atlassian import FakeAtlassian
+
+# pylint: disable=missing-function-docstring,missing-class-docstring,redefined-outer-name
+
+@pytest.fixture
+def fake():
+    with FakeAtlassian() as fake_atlassian:
+        fake_atlassian.add_page("Transport test")
+        yield fake_atlassian
+
+
+class TestTransport:
+
+    @staticmethod
+    def page_url(fake: FakeAtlassian) -> str:
+        return f"{fake.url}wiki/rest/api/content/{list(fake.pages)[0]}"
+
+    def test_retry_after_is_honored(self, fake):
+        transport = Transport(scheduler=RequestScheduler(backoff=10))
+        fake.throttle(2, retry_after="0.2")
+
+        start = time.perf_counter()
+        response = transport.session.get(self.page_url(fake))
+        assert response.status_code == 200
+        assert time.perf_counter() - start >= 0.4
+        assert transport.stats()["throttled"] == 2
+        assert transport.stats()["retried"] == 2
+        assert transport.stats()["requests"] == 3
+
+    def test_backoff_without_retry_after(self, fake):
+        transport = Transport(scheduler=RequestScheduler(backoff=0.01))
+        fake.throttle(3, status=503)
+        assert transport.session.get(self.page_url(fake)).status_code == 200
+        assert transport.stats()["retried"] == 3
+
+    def test_non_idempotent_503_is_not_retried(self, fake):
+        transport = Transport(scheduler=RequestScheduler(backoff=0.01))
+        fake.throttle(1, status=503)
+        assert transport.session.post(f"{self.page_url(fake)}/label",
+                                      json={"name": "x"}).status_code == 503
+        assert transport.stats()["retried"] == 0
+
+        fake.throttle(1, status=429)
+        assert transport.session.post(f"{self.page_url(fake)}/label",
+                                      json={"name": "x"}).status_code == 200
+        assert transport.stats()["retried"] == 1
+
+    def test_max_retries(self, fake):
+        transport = Transport(scheduler=RequestScheduler(max_retries=2, backoff=0.01))
+        fake.throttle(5)
+        assert transport.session.get(self.page_url(fake)).status_code == 429
+        assert transport.stats()["requests"] == 3
+
+    def test_max_retries_through_client(self, fake, monkeypatch, tmp_path):
+        monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+        transport = Transport(scheduler=RequestScheduler(max_retries=2, backoff=0.01))
+        confluence = ConfluenceMD(username="user", md_file=None, token="token", url=fake.url,
+                                  transport=transport)
+        fake.throttle(8, retry_after="0")
+        with pytest.raises(HTTPError):
+            confluence.get_page_by_id(list(fake.pages)[0])
+        assert transport.stats()["requests"] == 3
+        assert transport.stats()["retried"] == 2
+
+    def test_client_retry_options(self, monkeypatch):
+        assert confluencemd.client_retry_options() == {"backoff_and_retry": False,
+                                                       "retry_with_header": False}
+
+        class OldClient:  # pylint: disable=too-few-public-methods,unused-argument
+            def __init__(self, url, timeout=75, session=None):
+                pass
+
+        monkeypatch.setattr(confluencemd, "AtlassianRestAPI", OldClient)
+        assert not confluencemd.client_retry_options()
+
+    def test_http_date_retry_after_through_client(self, fake, monkeypatch, tmp_path):
+        monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+        transport = Transport(scheduler=RequestScheduler(backoff=10))
+        confluence = ConfluenceMD(username="user", md_file=None, token="token", url=fake.url,
+                                  transport=transport)
+        fake.throttle(1, retry_after="Wed, 21 Oct 2015 07:28:00 GMT")
+        assert confluence.get_page_by_id(list(fake.pages)[0])["title"] == "Transport test"
+        assert transport.stats()["retried"] == 1
+
+    def test_max_rps(self, fake):
+        transport = Transport(scheduler=RequestScheduler(max_rps=10))
+        start = time.perf_counter()
+        for _ in range(5):
+            transport.session.get(self.page_url(fake))
+        assert time.perf_counter() - start >= 0.4
+
+    def test_rate_limited_server(self, fake):
+        transport = Transport()
+        fake.rate_limit = 3
+        responses = [transport.session.get(self.page_url(fake)) for _ in range(5)]
+        assert [response.status_code for response in responses] == [200] * 5
+        assert transport.stats()["throttled"] >= 1
+        assert fake.bytes_sent > 0